@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+# Compare the IVSHMEM_Event_Notifier backends: latency from incr() to the
+# EventfdDispatcher callback through a live reactor, and raw incr()/reset()
+# pairs per second.  Run from the top of the repo:
+#   python3 "docs/experiments/02 notifier bench.py" [iterations]
+
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.internet import reactor
+
+from ivshmem_twisted.ivshmem_eventfd import (
+    IVSHMEM_Event_Notifier, EventfdDispatcher, NOTIFIER_BACKENDS)
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+results = []
+
+def latency(backends):
+    if not backends:
+        reactor.stop()
+        return
+    name = backends.pop(0)
+    try:
+        IVSHMEM_Event_Notifier.use_backend(name)
+        EN = IVSHMEM_Event_Notifier()
+    except Exception as e:
+        print('%-8s unavailable: %s' % (name, str(e)))
+        reactor.callLater(0, latency, backends)
+        return
+    EN.num = 1
+    dispatcher = EventfdDispatcher()
+    samples = []
+    t0 = [0]
+
+    def kick():
+        t0[0] = perf_counter()
+        EN.incr()
+
+    def callback(vectorobj, count):
+        samples.append(perf_counter() - t0[0])
+        if len(samples) < N // 10:
+            reactor.callLater(0, kick)
+            return
+        dispatcher.remove(EN)
+        dispatcher.destroy()
+        samples.sort()
+        results.append((name, samples[len(samples) // 2],
+                        samples[len(samples) * 99 // 100], throughput(EN)))
+        EN.cleanup()
+        reactor.callLater(0, latency, backends)
+
+    dispatcher.add(EN, callback, None)
+    dispatcher.start()
+    reactor.callLater(0, kick)
+
+def throughput(EN):
+    start = perf_counter()
+    for _ in range(N):
+        EN.incr()
+        EN.reset()
+    return N / (perf_counter() - start)
+
+reactor.callLater(0, latency, list(NOTIFIER_BACKENDS))
+reactor.run()
+
+print('%-8s %12s %12s %14s' % ('backend', 'median us', '99% us', 'pairs/sec'))
+for name, median, p99, rate in results:
+    print('%-8s %12.1f %12.1f %14.0f' % (name, median * 1e6, p99 * 1e6, rate))
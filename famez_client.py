@@ -28,10 +28,25 @@ def parse_cmdline(cmdline_args):
         epilog='Options reflect those in the QEMU "ivshmem-client".'
     )
     parser.add_argument('-?', action='help')  # -h and --help are built in
+    parser.add_argument('--binary',
+        help='Offer the binary payload codec in Peer-Attribute exchanges',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--socketpath', '-S', metavar='/path/to/socket',
         help='Absolute path to UNIX domain socket created by the server',
         default='/tmp/famez_socket'
     )
+    parser.add_argument('--spin', metavar='<usecs>',
+        help='Poll doorbells this long after a message before blocking',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--suppress',
+        help='Hush doorbells while draining (needs --compact or rings)',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--verbose', '-v',
         help='Specify multiple times to increase verbosity',
         default=0,
@@ -40,6 +55,7 @@ def parse_cmdline(cmdline_args):
     args = parser.parse_args(cmdline_args)
 
     # Idiot checking.
+    assert 0 <= args.spin <= 100000, 'spin is out of range 0 - 100000'
     assert os.path.exists(args.socketpath), \
         'No such socket %s (have you started famez_server?)' % args.socketpath
 
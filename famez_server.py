@@ -26,6 +26,22 @@ def parse_cmdline(cmdline_args):
         epilog='Options reflect those in the QEMU "ivshmem-server".'
     )
     parser.add_argument('-?', action='help')  # -h and --help are built in
+    parser.add_argument('--binary',
+        help='Offer the binary payload codec in Peer-Attribute exchanges',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--classes',
+        help='Separate control traffic class, its own rings and vector '
+             '(needs --compact)',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--compact',
+        help='Two vectors per peer instead of nEvents (not for QEMU/famez.ko)',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--daemon', '-D',
         help='Run in background, log to file (default: foreground/stdout)',
         # The twisted module expectes the attribute 'foreground'...
@@ -33,6 +49,16 @@ def parse_cmdline(cmdline_args):
         action='store_false',   # ...so reverse the polarity, Scotty
         default=True
     )
+    parser.add_argument('--depth', metavar='<integer>',
+        help='Mailslot ring depth per sender (default 1 == QEMU/famez.ko)',
+        type=int,
+        default=1
+    )
+    parser.add_argument('--hugepages',
+        help='Back the mailbox with huge pages (/dev/hugepages or memfd)',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--logfile', '-L', metavar='<name>',
         help='Pathname of logfile for use in daemon mode',
         default='/tmp/famez_log'
@@ -41,8 +67,23 @@ def parse_cmdline(cmdline_args):
         help='Name of mailbox that exists in POSIX shared memory',
         default='famez_mailbox'
     )
+    parser.add_argument('--matrix',
+        help='Mailslot lane per sender/destination pair (not for famez.ko)',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--memfd',
+        help='Mailbox is an anonymous memfd instead of a named file',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--multicast',
+        help='Add an ack table so "all"/"others" load a mailslot once',
+        action='store_true',
+        default=False
+    )
     parser.add_argument('--nClients', '-n', metavar='<integer>',
-        help='Serve up to this number of clients (max=14)',
+        help='Serve up to this number of clients (max=62)',
         type=int,
         default=14
     )
@@ -52,15 +93,50 @@ def parse_cmdline(cmdline_args):
         action='store_false',
         default=True
     )
+    parser.add_argument('--notifier',
+        help='How to make doorbell fds (default: os if available, else ctypes)',
+        choices=('os', 'ctypes', 'pipe'),
+        default=None
+    )
+    parser.add_argument('--prefault',
+        help='Populate and mlock the mailbox mapping (clients too)',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--retries', metavar='<integer>',
+        help='Retransmit unacknowledged CTL-Write this often (default 2)',
+        type=int,
+        default=2
+    )
     parser.add_argument('--silent', '-s',
         help='Do NOT participate in EventFDs/mailbox as another peer',
         action='store_true',
         default=False
     )
+    parser.add_argument('--slotsize', metavar='<integer>',
+        help='Mailslot size in bytes, a power of two (default 512)',
+        type=int,
+        default=512
+    )
     parser.add_argument('--socketpath', '-S', metavar='/path/to/socket',
         help='Absolute path to UNIX domain socket (will be created)',
         default='/tmp/famez_socket'
     )
+    parser.add_argument('--spin', metavar='<usecs>',
+        help='Poll doorbells this long after a message before blocking',
+        type=int,
+        default=0
+    )
+    parser.add_argument('--suppress',
+        help='Hush doorbells while draining (needs --compact or rings)',
+        action='store_true',
+        default=False
+    )
+    parser.add_argument('--tagtime', metavar='<msecs>',
+        help='Wait this long for a tagged acknowledgment (default 1000)',
+        type=int,
+        default=1000
+    )
     parser.add_argument('--verbose', '-v',
         help='Specify multiple times to increase verbosity',
         default=0,
@@ -76,6 +152,14 @@ def parse_cmdline(cmdline_args):
     # Generate the object and postprocess some of the fields.
     args = parser.parse_args(cmdline_args)
     assert 1 <= args.nClients <= 62, 'nClients is out of range 1 - 62'
+    assert 1 <= args.depth <= 64, 'depth is out of range 1 - 64'
+    assert 0 <= args.spin <= 100000, 'spin is out of range 0 - 100000'
+    assert 0 <= args.retries <= 10, 'retries is out of range 0 - 10'
+    assert args.compact or not args.classes, 'classes needs compact'
+    assert 50 <= args.tagtime <= 60000, 'tagtime is out of range 50 - 60000'
+    assert 256 <= args.slotsize <= 65536 and \
+        not args.slotsize & (args.slotsize - 1), \
+        'slotsize must be a power of two in range 256 - 65536'
     assert not (args.silent and args.smart), \
         'Silent/smart are mutually exclusive'
     assert not '/' in args.mailbox, 'mailbox cannot have slashes'
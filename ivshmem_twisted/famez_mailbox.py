@@ -7,27 +7,79 @@
 # entry "nClients + 1" is the server mailslot.  This is contiguous because it
 # it aligns with how QEMU expects delivery of peer info, including the FAME-Z
 # server (which is an extension beyond stock QEMU IVSHMSG protocol).
-# Right now a mailslot is 512 bytes: 128 bytes of metadata (currently about
-# 96 used), then 384 of message buffer.
-# Go for the max slots in the file to hardwire libvirt domain XML file size.
-# famez.ko will read the global data to understand the mailbox layout.
+# By default a mailslot is 512 bytes: 128 bytes of metadata (currently about
+# 96 used), then 384 of message buffer.  The server can choose a bigger
+# power-of-two slot size.  The slot count is nClients + 2 rounded up to a
+# power of two, but never below 16 to keep the legacy file size for libvirt
+# domain XML files.  famez.ko will read the global data to understand the
+# mailbox layout.
+
+# Optionally (depth > 1) each sender also owns a ring of "depth" cells past
+# the mailslots.  A cell is laid out exactly like a mailslot; only msglen,
+# last_responder (the destination) and the message are used.  A table of
+# (head, tail) pairs, one per ring, precedes the cells.  The sender owns
+# both indices: head counts cells posted, and tail is advanced past cells
+# whose msglen was cleared by their receiver.  With a matrix each sender has
+# one ring (lane) per destination so independent conversations never wait
+# on each other; depth may be 1 in that case.  Python peers only, famez.ko
+# refuses a mailbox with rings.
+
+# Optionally (multicast) an ack table follows, one uint64_t per (receiver,
+# sender) pair and written only by that receiver.  A multicast cell carries
+# a receiver bitmask and a per-sender multicast id; each receiver stores
+# the id in its ack entry instead of clearing msglen, and the sender clears
+# msglen itself once every receiver in the mask has caught up.  So the
+# message is written once no matter how many doorbells get rung.  Only
+# peers advertising FLAG_MCAST (Python, single lane) are put in a mask;
+# everybody else gets the unicast copy as before.
+
+# Normally every peer has nEvents vectors and the vector number rung is the
+# sender id, so each process holds an eventfd per (peer, sender) pair.  In
+# compact mode (Python only) every peer has COMPACT_VECTORS: the release
+# doorbell and one "you've got mail" doorbell shared by all senders, and
+# the receiver finds the senders by scanning the mailbox for cells
+# addressed to it.  fd counts then grow linearly with the peers.
+
+# Traffic classes (compact mode, rings).  With two classes every lane is
+# repeated in a second block of rings and cells for control traffic (Link
+# CTL, CTL-Write, acknowledgments) with its own CONTROL_VECTOR, so fabric
+# management never queues behind bulk data.  Receivers take the control
+# class first whichever doorbell woke them.
+
+# The backing store is normally a file in /dev/shm.  It can also be a file
+# on hugetlbfs (/dev/hugepages) or an anonymous memfd, optionally with huge
+# pages; QEMU only ever sees the fd.  "Prefault" populates and mlocks the
+# mapping up front so the hot slot headers never take a first-touch fault;
+# clients follow suit from a flag in the globals.
 
 # All numbers are unsigned long long (8 bytes).  All strings are multiples
 # of 16 (including the C terminating NULL) on 32-byte boundaries.  Then it
 # all looks good in "od -Ad -c" and even better in "od -Ax -c -tu8 -tx8".
 
+import grp
 import mmap
 import os
 import struct
+from collections import deque
 from time import sleep
 from time import time as NOW
 
 from os.path import stat as STAT    # for constants
 from pdb import set_trace
 
+from twisted.internet import defer as TIdefer
+from twisted.internet import reactor as TIreactor
+
+# Precompiled layouts for the per-message paths.  unpack_from/pack_into work
+# directly on the mmap so reading a length doesn't slice out a copy first.
+_QUAD = struct.Struct('Q')
+_PAIR = struct.Struct('QQ')
+
 class FAMEZ_MailBox(object):
 
-    # QEMU rules: file size (product of first two) must be a power of two.
+    # QEMU rules: file size must be a power of two.  These are the defaults
+    # and minimums; the server sets them from the command line and clients
+    # read them back out of the globals.
     MAILBOX_SLOTSIZE = 512
     MAILBOX_MAX_SLOTS = 16    # Dummy + server leaves 14 actual clients
 
@@ -36,6 +88,20 @@ class FAMEZ_MailBox(object):
     G_NCLIENTS_off = 16
     G_NEVENTS_off = 24
     G_SERVER_ID_off = 32
+    G_DEPTH_off = 40
+    G_RING_off = 48           # (head, tail) table, 0 if depth == 1
+    G_CELL_off = 56           # First ring cell, 0 if depth == 1
+    G_LANES_off = 64          # Lanes per sender: 1 or a matrix
+    G_NSLOTS_off = 72         # MAILBOX_MAX_SLOTS for this run
+    G_FLAGS_off = 80
+    G_ACK_off = 88            # Multicast ack table, 0 if not enabled
+    G_VECTORS_off = 96        # Vectors per peer, 0 == nEvents (QEMU)
+    G_CLASSES_off = 104       # Traffic classes, 0 or 1 == just data
+
+    GF_PREFAULT = 1           # Populate and mlock the mapping
+    GF_HUGEPAGES = 2          # Informational
+
+    RING_HDR_SIZE = 16        # head and tail, both uint64_t
 
     # Metadata (front of famez_mailslot_t) is char[32] plus a few uint64_t.
     # The actual message space starts after that, 32-byte aligned, which
@@ -54,16 +120,110 @@ class FAMEZ_MailBox(object):
     # Datum 4: 1 long
     MS_LAST_RESPONDER_off = MS_PEER_ID_off + 8
 
-    # 9 longs of padding == 12 longs after char[32] and finally...
+    # Data 5 and 6: peer_SID and peer_CID, only used by famez.ko
+
+    # Datum 7: 1 long, fragment header written by fill_async() for messages
+    # that don't fit a cell: fragment id << 32 | index << 16 | count.
+    # Zero for an unfragmented message.
+    MS_FRAG_off = MS_LAST_RESPONDER_off + 24
+
+    # Datum 8: 1 long, flags only written by the owner of a mailslot (not
+    # used in ring cells).  FLAG_RELEASE: "ring my RELEASE_VECTOR after
+    # emptying a cell of mine" so I don't have to poll msglen.  famez.ko
+    # never sets it and so never sees that vector.
+    MS_FLAGS_off = MS_FRAG_off + 8
+    FLAG_RELEASE = 1
+    RELEASE_VECTOR = 0        # Slot 0 is the globals so nobody sends from it
+    DOORBELL_VECTOR = 1       # Compact mode: mail from anybody
+    COMPACT_VECTORS = 2
+    CONTROL_VECTOR = 2        # Compact mode with classes: control mail
+    TC_DATA = 0
+    TC_CONTROL = 1
+
+    # Flag FLAG_MCAST: "put me in multicast masks", ie, I ack them.
+    FLAG_MCAST = 2
+
+    # Flag FLAG_NO_NOTIFY: "I'm draining (or spinning) right now, don't
+    # ring me", like virtio's VRING_USED_F_NO_NOTIFY.  Senders check it
+    # after placing a cell; the owner clears it and looks at the mailbox
+    # once more before it sleeps.  Needs cells addressed to a receiver
+    # (compact or rings) so that look is meaningful.
+    FLAG_NO_NOTIFY = 4
+
+    # Flag FLAG_FRAGMENTS: "I reassemble fragmented messages".  famez.ko
+    # only has the header fields, so it never gets a message bigger than
+    # a cell.
+    FLAG_FRAGMENTS = 8
+
+    # Datum 9: 1 long, sequence number of the cell for its sender and
+    # destination, starting at 1.  Zero (famez.ko) is not checked, and
+    # multicast cells use zero.
+    MS_SEQ_off = MS_FLAGS_off + 8
+
+    # Data 10 and 11: receiver bitmask of a multicast cell (zero for
+    # unicast) and the sender's multicast id it will be acked with.
+    MS_RCVMASK_off = MS_SEQ_off + 8
+    MS_MCAST_ID_off = MS_RCVMASK_off + 8
+
+    # 2 longs of padding == 12 longs after char[32] and finally...
 
     MS_MSG_off = 128
-    MS_MAX_MSGLEN = 384
+    MS_MAX_MSGLEN = 384       # MAILBOX_SLOTSIZE - MS_MSG_off
 
     fd = None       # There can be only one
     mm = None       # Then I can access fill() from the class
     nClients = None
     nEvents = None
     server_id = None
+    depth = 1
+    lanes = 1
+    ring_off = 0
+    cell_off = 0
+    ack_off = 0
+    vectors = 0
+    classes = 1
+
+    # fill_async() parks messages here per lane until the previous
+    # responder clears msglen.  The reactor polls with a backoff similar
+    # to famez_create_outgoing() instead of sleeping in fill().
+    FILL_TIMEOUT = 1.05
+    FILL_POLL_MIN = 0.001
+    FILL_POLL_MAX = 0.1
+
+    # Each lane holds a bounded queue per destination (None for multicast)
+    # and deficit round robin picks the next cell, so one slow or chatty
+    # destination doesn't hold up the rest.  A fragmented message goes
+    # out whole and counts once against QUEUE_LIMIT; past that the
+    # Deferred fails.  Senders can watch backlog() against QUEUE_HIGH and
+    # ask when_room() to hear when it's back down to QUEUE_LOW.
+    QUEUE_LIMIT = 64        # messages per (lane, destination)
+    QUEUE_HIGH = 48
+    QUEUE_LOW = 16
+
+    _pending = {}           # lane: { dest_id: deque of (sender_id, msg,
+                            #   dest_id, mask, frag, doorbell, Deferred) }
+    _active = {}            # lane: deque of dest_ids with something queued
+    _deficit = {}           # (lane, dest_id): DRR byte credit
+    _messages = {}          # (lane, dest_id): whole messages queued
+    _midmsg = set()         # lanes partway through a fragmented message
+    _waiters = {}           # (sender_id, dest_id): when_room() callbacks
+    _draining = set()       # lanes with a drain running or scheduled
+    _retry = {}             # lane: (DelayedCall, stop) of a scheduled drain
+    _next_fragid = {}       # lane: last fragment id used
+
+    _partial = {}           # (sender_id, receiver_id, tclass):
+                            #   [fragid, chunks]
+
+    _mcast_id = {}          # sender_id: last multicast id used
+
+    # Loss accounting per remote peer, for the "dump" commands.  sent and
+    # stomps are cells this process posted to that peer (stomps were
+    # overwritten before it took them), rcvd/gaps/dups are cells from it.
+    # quiet counts doorbells not rung because that peer was draining.
+    STAT_NAMES = ('sent', 'rcvd', 'stomps', 'gaps', 'dups', 'quiet')
+    stats = {}              # peer_id: { STAT_NAMES: count }
+    _seq_out = {}           # (lane, dest_id): last sequence number sent
+    _seq_in = {}            # (sender_id, receiver_id, tclass): last one
 
     #-----------------------------------------------------------------------
     # Globals at offset 0 (slot 0)
@@ -71,18 +231,97 @@ class FAMEZ_MailBox(object):
     # Server mailbox is always at the slot following the nClients.
     # First 32 bytes of any slot are NUL-terminated host name (a C string).
 
+    @classmethod
+    def _geometry(cls, slotsize, nSlots):
+        assert slotsize > cls.MS_MSG_off, 'Slot size is too small'
+        assert not slotsize & (slotsize - 1), 'Slot size not a power of two'
+        cls.MAILBOX_SLOTSIZE = slotsize
+        cls.MAILBOX_MAX_SLOTS = nSlots
+        cls.MS_MAX_MSGLEN = slotsize - cls.MS_MSG_off
+
+    @classmethod
+    def _layout(cls, nClients, slotsize=512, depth=1, matrix=False,
+                multicast=False, classes=1):
+        '''Set the geometry and ring offsets, return the (power of two)
+           file size.'''
+        nSlots = max(16, 1 << (nClients + 1).bit_length())   # + 2, rounded
+        cls._geometry(slotsize, nSlots)
+        end = cls.MAILBOX_MAX_SLOTS * cls.MAILBOX_SLOTSIZE
+        cls.depth = depth
+        cls.lanes = cls.MAILBOX_MAX_SLOTS if matrix else 1
+        cls.classes = classes
+        if depth > 1 or matrix or classes > 1:
+            nLanes = cls.MAILBOX_MAX_SLOTS * cls.lanes * classes
+            table = nLanes * cls.RING_HDR_SIZE
+            table = -(-table // cls.MAILBOX_SLOTSIZE) * cls.MAILBOX_SLOTSIZE
+            cls.ring_off = end
+            cls.cell_off = end + table
+            end = cls.cell_off + nLanes * depth * cls.MAILBOX_SLOTSIZE
+        if multicast:
+            table = cls.MAILBOX_MAX_SLOTS * cls.MAILBOX_MAX_SLOTS * 8
+            cls.ack_off = end
+            end += -(-table // cls.MAILBOX_SLOTSIZE) * cls.MAILBOX_SLOTSIZE
+        return 1 << (end - 1).bit_length()
+
+    def _grow(self, fd, oldsize):
+        '''fallocate where the filesystem has it (tmpfs), else truncate.'''
+        try:
+            os.posix_fallocate(fd, 0, self.filesize)
+        except OSError as e:
+            os.ftruncate(fd, self.filesize)
+        if os.fstat(fd).st_size < self.filesize:
+            os.close(fd)
+            raise OSError('existing size (%d) is < required (%d) and '
+                'cannot be resized' % (oldsize, self.filesize))
+
+    @staticmethod
+    def _hugepagesize():
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('Hugepagesize:'):
+                        return int(line.split()[1]) * 1024
+        except Exception as e:
+            pass
+        return 2 << 20
+
+    @staticmethod
+    def _mlock(mm):
+        import ctypes       # Only needed for prefault
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            buf = (ctypes.c_char * len(mm)).from_buffer(mm)
+            if libc.mlock(ctypes.addressof(buf), ctypes.c_size_t(len(mm))):
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+        except Exception as e:
+            print('mlock of mailbox failed (RLIMIT_MEMLOCK?): %s' % str(e))
+
+    @classmethod
+    def _map(cls, prefault=False):
+        flags = mmap.MAP_SHARED
+        if prefault:
+            flags |= getattr(mmap, 'MAP_POPULATE', 0x8000)
+        cls.mm = mmap.mmap(cls.fd, 0, flags=flags)
+        if prefault:
+            cls._mlock(cls.mm)
 
     def _initialize_mailbox(self, args):
-        self.__class__.mm = mmap.mmap(self.fd, 0)       # Only done once
+        self._map(self.gflags & self.GF_PREFAULT)       # Only done once
 
-        # Empty it.  Simple code that's never too demanding on size (now 32k)
-        data = b'\0' * self.filesize
-        self.mm[0:len(data)] = data
+        # Empty it.  Rings and big slots can add up, so go a meg at a time.
+        chunk = 1 << 20
+        data = b'\0' * min(chunk, self.filesize)
+        for index in range(0, self.filesize, chunk):
+            self.mm[index:index + len(data)] = data
 
         # Fill in the globals; used by famez.ko and the C struct famez_globals.
-        data = struct.pack('QQQQQ',                         # unsigned long long
-            self.MAILBOX_SLOTSIZE, self.MS_MSG_off,         # constants
-            args.nClients, args.nEvents, args.server_id)    # runtime
+        data = struct.pack('QQQQQQQQQQQQQQ',               # unsigned long long
+            self.MAILBOX_SLOTSIZE, self.MS_MSG_off,         # geometry
+            args.nClients, args.nEvents, args.server_id,    # runtime
+            self.depth, self.ring_off, self.cell_off, self.lanes,
+            self.MAILBOX_MAX_SLOTS, self.gflags, self.ack_off, self.vectors,
+            self.classes)
         self.mm[0:len(data)] = data
 
         # Set the peer_id for each slot as a C integer.  While python client
@@ -119,10 +358,6 @@ class FAMEZ_MailBox(object):
             return
         self.__class__._beetnheredonethat = True
 
-        assert (self.MS_MSG_off + self.MS_MAX_MSGLEN
-            == self.MAILBOX_SLOTSIZE), 'Fix this NOW'
-        self.filesize = self.MAILBOX_MAX_SLOTS * self.MAILBOX_SLOTSIZE
-
         if args is None:
             assert fd > 0 and client_id > 0 and isinstance(nodename, str), \
                 'Bad call, ump!'
@@ -131,6 +366,34 @@ class FAMEZ_MailBox(object):
             self._init_mailslot(client_id, nodename)
             return
         assert fd == -1 and client_id == -1, 'Cannot assign ids to server'
+        self.filesize = self._layout(args.nClients,
+            slotsize=getattr(args, 'slotsize', self.MAILBOX_SLOTSIZE),
+            depth=getattr(args, 'depth', 1),
+            matrix=getattr(args, 'matrix', False),
+            multicast=getattr(args, 'multicast', False),
+            classes=2 if getattr(args, 'classes', False) else 1)
+        if getattr(args, 'compact', False):
+            self.__class__.vectors = self.COMPACT_VECTORS + (
+                self.classes > 1)
+        hugepages = getattr(args, 'hugepages', False)
+        self.gflags = self.GF_HUGEPAGES if hugepages else 0
+        if getattr(args, 'prefault', False):
+            self.gflags |= self.GF_PREFAULT
+        if hugepages:   # Both are powers of two
+            self.filesize = max(self.filesize, self._hugepagesize())
+
+        if getattr(args, 'memfd', False):
+            flags = os.MFD_CLOEXEC | (os.MFD_HUGETLB if hugepages else 0)
+            try:
+                fd = os.memfd_create(args.mailbox, flags)
+                os.ftruncate(fd, self.filesize)
+            except Exception as e:
+                raise RuntimeError('Problem with memfd %s: %s' % (
+                    args.mailbox, str(e)))
+            self.path = None                    # Only the fd exists
+            self.__class__.fd = fd
+            self._initialize_mailbox(args)
+            return
 
         path = args.mailbox     # Match previously written code
         gr_gid = -1     # Makes no change.  Try Debian, CentOS, other
@@ -142,7 +405,7 @@ class FAMEZ_MailBox(object):
                 pass
 
         if '/' not in path:
-            path = '/dev/shm/' + path
+            path = ('/dev/hugepages/' if hugepages else '/dev/shm/') + path
         oldumask = os.umask(0)
         try:
             if not os.path.isfile(path):
@@ -152,9 +415,6 @@ class FAMEZ_MailBox(object):
             else:   # Re-condition and re-use
                 lstat = os.lstat(path)
                 assert STAT.S_ISREG(lstat.st_mode), 'not a regular file'
-                assert lstat.st_size >= self.filesize, \
-                    'existing size (%d) is < required (%d)' % (
-                        lstat.st_size, self.filesize)
                 if lstat.st_gid != gr_gid and gr_gid > 0:
                     print('Changing %s to group %s' % (path, gr_name))
                     os.chown(path, -1, gr_gid)
@@ -162,6 +422,10 @@ class FAMEZ_MailBox(object):
                     print('Changing %s to permissions 666' % path)
                     os.chmod(path, 0o666)
                 fd = os.open(path, os.O_RDWR)
+                if lstat.st_size < self.filesize:   # Left by a smaller run
+                    print('Growing %s from %d to %d bytes' % (
+                        path, lstat.st_size, self.filesize))
+                    self._grow(fd, lstat.st_size)
         except Exception as e:
             raise RuntimeError('Problem with %s: %s' % (path, str(e)))
 
@@ -171,36 +435,259 @@ class FAMEZ_MailBox(object):
         self.__class__.fd = fd
         self._initialize_mailbox(args)
 
+    #----------------------------------------------------------------------
+    # Cells hold the messages and lanes hold the cells.  A sender has one
+    # lane shared by all destinations, or with a matrix one per destination.
+    # Without rings a sender's only cell is its mailslot, otherwise it's one
+    # of the lane's ring cells indexed by a head or tail count.  Control
+    # class lanes follow all the data class lanes.
+
+    @classmethod
+    def _lane(cls, sender_id, dest_id, tclass=0):
+        base = tclass * cls.MAILBOX_MAX_SLOTS * cls.lanes
+        if cls.lanes == 1:
+            return base + sender_id
+        assert dest_id, 'Mailbox matrix needs a destination'
+        return base + sender_id * cls.lanes + dest_id
+
+    @classmethod
+    def _sender(cls, lane):
+        lane %= cls.MAILBOX_MAX_SLOTS * cls.lanes
+        return lane if cls.lanes == 1 else lane // cls.lanes
+
+    @classmethod
+    def _priority(cls, tclass=None):
+        '''Classes to look at, control first.'''
+        if tclass is not None:
+            return (tclass, )
+        return (cls.TC_CONTROL, cls.TC_DATA) if cls.classes > 1 else (0, )
+
+    @classmethod
+    def _cell(cls, lane, count=0):
+        if not cls.ring_off:
+            return lane * cls.MAILBOX_SLOTSIZE
+        return cls.cell_off + cls.MAILBOX_SLOTSIZE * (
+            lane * cls.depth + count % cls.depth)
+
+    @classmethod
+    def _ring(cls, lane):
+        index = cls.ring_off + lane * cls.RING_HDR_SIZE
+        head, tail = _PAIR.unpack_from(cls.mm, index)
+        return index, head, tail
+
+    @classmethod
+    def _msglen(cls, cell):
+        return _QUAD.unpack_from(cls.mm, cell + cls.MS_MSGLEN_off)[0]
+
+    @classmethod
+    def _ack_index(cls, receiver_id, sender_id):
+        return cls.ack_off + 8 * (
+            receiver_id * cls.MAILBOX_MAX_SLOTS + sender_id)
+
+    @classmethod
+    def _addressed(cls, cell, sender_id, receiver_id, unicast=True):
+        '''Is the message in cell still for receiver_id?  A multicast is
+           until receiver_id acks it; unicast checks the destination.'''
+        if receiver_id is None:
+            return True
+        mask, mcast_id = _PAIR.unpack_from(cls.mm, cell + cls.MS_RCVMASK_off)
+        if mask:
+            return bool(mask >> receiver_id & 1) and _QUAD.unpack_from(cls.mm,
+                cls._ack_index(receiver_id, sender_id))[0] < mcast_id
+        return not unicast or _QUAD.unpack_from(cls.mm,
+            cell + cls.MS_LAST_RESPONDER_off)[0] == receiver_id
+
+    @classmethod
+    def _pending_cells(cls, sender_id, receiver_id=None, tclass=None):
+        '''Oldest first (per class, control first).  Legacy unicast is not
+           filtered by receiver because the vector said it was for me (not
+           so in compact).'''
+        if not cls.ring_off:
+            cell = cls._cell(sender_id)
+            if not cls._msglen(cell):
+                return []
+            return [ cell ] if cls._addressed(cell, sender_id, receiver_id,
+                unicast=bool(cls.vectors)) else []
+        cells = []
+        for tc in cls._priority(tclass):
+            cells.extend(cls._class_cells(sender_id, receiver_id, tc))
+        return cells
+
+    @classmethod
+    def _class_cells(cls, sender_id, receiver_id, tclass):
+        if cls.lanes == 1:
+            lanes = (cls._lane(sender_id, None, tclass), )
+        elif receiver_id is None:
+            first = cls._lane(sender_id, 1, tclass) - 1
+            lanes = range(first, first + cls.lanes)
+        else:
+            lanes = (cls._lane(sender_id, receiver_id, tclass), )
+            receiver_id = None      # The lane says it all
+        cells = []
+        for lane in lanes:
+            _, head, tail = cls._ring(lane)
+            for count in range(tail, head):
+                cell = cls._cell(lane, count)
+                if cls._msglen(cell) and cls._addressed(
+                    cell, sender_id, receiver_id):
+                    cells.append(cell)
+        return cells
+
+    #----------------------------------------------------------------------
+    # Which vector a sender rings at a receiver, and the other way around.
+
+    @classmethod
+    def vector(cls, sender_id, tclass=0):
+        if not cls.vectors:
+            return sender_id
+        if tclass and cls.classes > 1:
+            return cls.CONTROL_VECTOR
+        return cls.DOORBELL_VECTOR
+
+    @classmethod
+    def by_priority(cls, vector):
+        '''Classes to serve after a kick on vector: control traffic goes
+           first even when it was the data doorbell that rang.'''
+        if cls.classes < 2:
+            return (cls.TC_DATA, )
+        if vector == cls.CONTROL_VECTOR:
+            return (cls.TC_CONTROL, )
+        return (cls.TC_CONTROL, cls.TC_DATA)
+
+    @classmethod
+    def senders(cls, vector, receiver_id, tclass=None):
+        '''Sender ids that might have rung vector (not the release one),
+           or with something pending in tclass.'''
+        if not cls.vectors:
+            return (vector, )
+        return [ sender_id for sender_id in range(1, cls.server_id + 1)
+                 if cls._pending_cells(sender_id, receiver_id, tclass) ]
+
     #----------------------------------------------------------------------
     # Dig the mail and node name out of the slot for peer_id (1:1 mapping).
     # It's not so much (passively) receivng mail as it is actively getting.
 
     @classmethod
-    def retrieve(cls, peer_id, asbytes=False, clear=True):
-        '''Return the nodename and message.'''
+    def _consume(cls, cell, sender_id, receiver_id):
+        '''Clear msglen as the handshake that the cell was emptied.  A
+           multicast receiver acks instead; see _cell_empty().'''
+        mask, mcast_id = _PAIR.unpack_from(cls.mm, cell + cls.MS_RCVMASK_off)
+        if mask and receiver_id is not None:
+            _QUAD.pack_into(cls.mm,
+                cls._ack_index(receiver_id, sender_id), mcast_id)
+        else:
+            _QUAD.pack_into(cls.mm, cell + cls.MS_MSGLEN_off, 0)
+
+    @classmethod
+    def _copyout(cls, cell, asbytes, clear, sender_id=None, receiver_id=None):
+        '''One copy, straight out of the mmap into a new bytes.'''
+        msglen = cls._msglen(cell)
+        index = cell + cls.MS_MSG_off
+        msg = cls.mm[index:index + msglen]
+
+        # The message is copied so tell the requester.
+        if clear:
+            cls._consume(cell, sender_id, receiver_id)
+        return msg if asbytes else msg.decode()
+
+    @classmethod
+    def _nodename(cls, peer_id):
+        index = peer_id * cls.MAILBOX_SLOTSIZE     # start of nodename
+        nodename = cls.mm[index:index + cls.MS_NODENAME_SIZE]
+        return nodename.split(b'\0', 1)[0].decode()
+
+    @classmethod
+    def retrieve(cls, peer_id, asbytes=False, clear=True, receiver_id=None):
+        '''Return the nodename and (oldest) message.'''
         assert 1 <= peer_id <= cls.server_id, \
             'Slotnum is out of domain 1 - %d' % (cls.server_id)
-        index = peer_id * cls.MAILBOX_SLOTSIZE     # start of nodename
-        nodename, msglen = struct.unpack('32sQ', cls.mm[index:index + 40])
-        nodename = nodename.split(b'\0', 1)[0].decode()
-        index += cls.MS_MSG_off
-        fmt = '%ds' % msglen
-        msg = struct.unpack(fmt, cls.mm[index:index + msglen])
+        nodename = cls._nodename(peer_id)
+        cells = cls._pending_cells(peer_id, receiver_id)
+        if not cells:
+            return nodename, b'' if asbytes else ''
+        return nodename, cls._copyout(cells[0], asbytes, clear,
+            sender_id=peer_id, receiver_id=receiver_id)
 
-        # The message is copied so mark the mailslot length zero as handshake
-        # to the requester that its mailbox has been emptied.
+    @classmethod
+    def drain(cls, peer_id, receiver_id, asbytes=False, tclass=None):
+        '''Return a list of (nodename, message) for everything peer_id
+           has posted to receiver_id (in tclass, or control then data),
+           oldest first, clearing each.  Fragments are held back until
+           their message is complete.'''
+        assert 1 <= peer_id <= cls.server_id, \
+            'Slotnum is out of domain 1 - %d' % (cls.server_id)
+        nodename = cls._nodename(peer_id)
+        mail = []
+        for tc in cls._priority(tclass) if cls.ring_off else (0, ):
+            key = (peer_id, receiver_id, tc)
+            for cell in cls._pending_cells(peer_id, receiver_id, tc):
+                frag = _QUAD.unpack_from(cls.mm, cell + cls.MS_FRAG_off)[0]
+                cls._check_seq(key,
+                    _QUAD.unpack_from(cls.mm, cell + cls.MS_SEQ_off)[0])
+                msg = cls._copyout(cell, True, True,
+                    sender_id=peer_id, receiver_id=receiver_id)
+                if frag:
+                    msg = cls._reassemble(key, frag, msg)
+                    if msg is None:
+                        continue
+                mail.append((nodename, msg if asbytes else msg.decode()))
+        return mail
 
-        if clear:
-            index = peer_id * cls.MAILBOX_SLOTSIZE + cls.MS_MSGLEN_off
-            cls.mm[index:index + 8] = struct.pack('Q', 0)
+    @classmethod
+    def _count(cls, peer_id, what, n=1):
+        try:
+            cls.stats[peer_id][what] += n
+        except KeyError as e:
+            cls.stats[peer_id] = dict.fromkeys(cls.STAT_NAMES, 0)
+            cls.stats[peer_id][what] = n
 
-        # Clean up the message copyout, which is a single element tuple
-        # that has a NUL at msglen.
-        # msg = msg[0].split(b'\0', 1)[0] # only valid for pure stringsA
-        msg = msg[0][:msglen]
-        if not asbytes:
-            msg = msg.decode()
-        return nodename, msg
+    @classmethod
+    def _check_seq(cls, key, seq):
+        sender_id = key[0]
+        cls._count(sender_id, 'rcvd')
+        if not seq:
+            return
+        last = cls._seq_in.get(key, 0)
+        if seq == last + 1 or seq == 1:     # 1: the sender restarted
+            pass
+        elif seq <= last:
+            cls._count(sender_id, 'dups')
+            return                          # Don't go backwards
+        else:
+            cls._count(sender_id, 'gaps', seq - last - 1)
+        cls._seq_in[key] = seq
+
+    @classmethod
+    def stats_report(cls):
+        '''Lines of text for the "dump" commands.'''
+        lines = [ 'Peer' + ''.join('%8s' % name for name in cls.STAT_NAMES) ]
+        for peer_id in sorted(cls.stats):
+            counts = cls.stats[peer_id]
+            lines.append('%4d' % peer_id + ''.join(
+                '%8d' % counts[name] for name in cls.STAT_NAMES))
+        return lines
+
+    @classmethod
+    def _reassemble(cls, key, frag, chunk):
+        '''Return the whole message on its last fragment, else None.'''
+        fragid, index, count = frag >> 32, (frag >> 16) & 0xFFFF, frag & 0xFFFF
+        partial = cls._partial.get(key)
+        if not index:
+            if partial:
+                print('Fragments of message %d from %d lost' % (
+                    partial[0], key[0]))
+            partial = cls._partial[key] = [fragid, []]
+        elif partial is None or (partial[0] != fragid or
+                                 len(partial[1]) != index):
+            print('Fragment %d/%d of message %d from %d out of order' % (
+                index, count, fragid, key[0]))
+            cls._partial.pop(key, None)
+            return None
+        partial[1].append(chunk)
+        if index + 1 < count:
+            return None
+        del cls._partial[key]
+        return b''.join(partial[1])
 
     #----------------------------------------------------------------------
     # Post a message to the indicated mailbox slot but don't kick the
@@ -208,28 +695,435 @@ class FAMEZ_MailBox(object):
     # keeping it a separate operation facilitates sender spoofing.
 
     @classmethod
-    def fill(cls, sender_id, msg):
+    def _validate(cls, sender_id, msg):
         assert 1 <= sender_id <= cls.server_id, \
             'Peer ID is out of domain 1 - %d' % (cls.server_id)
         if isinstance(msg, str):
             msg = msg.encode()
         assert isinstance(msg, bytes), 'msg must be string or bytes'
+        return msg
+
+    @classmethod
+    def _cell_empty(cls, cell, sender_id):
+        '''A multicast cell is emptied here once every receiver in its mask
+           has acked it.'''
+        if not cls._msglen(cell):
+            return True
+        if not _QUAD.unpack_from(cls.mm, cell + cls.MS_RCVMASK_off)[0]:
+            return False
+        if cls._unacked(cell, sender_id):
+            return False
+        _QUAD.pack_into(cls.mm, cell + cls.MS_MSGLEN_off, 0)
+        return True
+
+    @classmethod
+    def _unacked(cls, cell, sender_id):
+        '''Receivers that haven't taken the message in cell yet.'''
+        mask, mcast_id = _PAIR.unpack_from(cls.mm, cell + cls.MS_RCVMASK_off)
+        if not mask:
+            return [ _QUAD.unpack_from(
+                cls.mm, cell + cls.MS_LAST_RESPONDER_off)[0] ]
+        return [ D for D in range(mask.bit_length()) if mask >> D & 1 and
+                 _QUAD.unpack_from(cls.mm,
+                    cls._ack_index(D, sender_id))[0] < mcast_id ]
+
+    @classmethod
+    def _slot_busy(cls, lane):
+        '''The previous responder needs to clear the msglen to indicate it
+           has pulled the message out of the sender's mailbox.  For a ring,
+           reclaim cleared cells at the tail first.'''
+        sender_id = cls._sender(lane)
+        if not cls.ring_off:
+            return not cls._cell_empty(cls._cell(lane), sender_id)
+        index, head, tail = cls._ring(lane)
+        oldtail = tail
+        while tail < head and cls._cell_empty(
+            cls._cell(lane, tail), sender_id):
+            tail += 1
+        if tail != oldtail:
+            _QUAD.pack_into(cls.mm, index + 8, tail)
+        return head - tail >= cls.depth
+
+    @classmethod
+    def _place(cls, lane, msg, dest_id, frag=0, mask=0):
+        if not cls.ring_off:
+            cell = cls._cell(lane)
+        else:
+            index, head, tail = cls._ring(lane)
+            if head - tail >= cls.depth:    # Stomp the oldest
+                tail = head - cls.depth + 1
+                _QUAD.pack_into(cls.mm, index + 8, tail)
+            cell = cls._cell(lane, head)
+        sender_id = cls._sender(lane)
+        if not cls._cell_empty(cell, sender_id):    # Count the loss
+            for dest in cls._unacked(cell, sender_id):
+                cls._count(dest, 'stomps')
+        if mask:
+            seq = 0
+            mcast_id = cls._next_mcast_id(sender_id, cell)
+            for dest in range(mask.bit_length()):
+                if mask >> dest & 1:
+                    cls._count(dest, 'sent')
+        else:
+            seq = cls._seq_out.get((lane, dest_id), 0) + 1
+            cls._seq_out[(lane, dest_id)] = seq
+            mcast_id = 0
+            cls._count(dest_id or 0, 'sent')
         msglen = len(msg)   # It's bytes now
-        assert msglen < cls.MS_MAX_MSGLEN, 'Message too long'
+        index = cell + cls.MS_MSG_off
+        cls.mm[index:index + msglen] = msg
+        cls.mm[index + msglen] = 0     # NUL-terminate the message.
+        _QUAD.pack_into(cls.mm, cell + cls.MS_LAST_RESPONDER_off, dest_id or 0)
+        _QUAD.pack_into(cls.mm, cell + cls.MS_FRAG_off, frag)
+        _QUAD.pack_into(cls.mm, cell + cls.MS_SEQ_off, seq)
+        _PAIR.pack_into(cls.mm, cell + cls.MS_RCVMASK_off, mask, mcast_id)
+        _QUAD.pack_into(cls.mm, cell + cls.MS_MSGLEN_off, msglen)
+        if cls.ring_off:        # Publish it
+            _QUAD.pack_into(cls.mm,
+                cls.ring_off + lane * cls.RING_HDR_SIZE, head + 1)
 
-        # The previous responder needs to clear the msglen to indicate it
-        # has pulled the message out of the sender's mailbox.
-        index = sender_id * cls.MAILBOX_SLOTSIZE + cls.MS_MSGLEN_off
-        stop = NOW() + 1.05
-        while NOW() < stop and struct.unpack('Q', cls.mm[index:index+8])[0]:
+    @classmethod
+    def fill(cls, sender_id, msg, dest_id=None):
+        msg = cls._validate(sender_id, msg)
+        assert len(msg) < cls.MS_MAX_MSGLEN, 'Message too long'
+        lane = cls._lane(sender_id, dest_id)
+        stop = NOW() + cls.FILL_TIMEOUT
+        while NOW() < stop and cls._slot_busy(lane):
             sleep(0.1)
         if NOW() >= stop:
             print('pseudo-HW not ready to receive timeout: now stomping')
+        cls._place(lane, msg, dest_id)
 
-        cls.mm[index:index + 8] = struct.pack('Q', msglen)
-        index = sender_id * cls.MAILBOX_SLOTSIZE + cls.MS_MSG_off
-        cls.mm[index:index + msglen] = msg
-        cls.mm[index + msglen] = 0     # NUL-terminate the message.
+    #----------------------------------------------------------------------
+    # Same as fill() but never sleeps on the reactor thread.  The message
+    # is queued behind any others in the same lane; the returned Deferred
+    # fires with sender_id once the message is in the slot.  Order is
+    # preserved per lane so with a matrix, a slow destination doesn't hold
+    # up the others.  A message too big for one cell is split into
+    # fragments if the receiver set FLAG_FRAGMENTS (else the Deferred fails
+    # with ValueError, as it does with RuntimeError for a full queue); each
+    # needs the receiver to empty the previous one, so doorbell() (if
+    # given) is called after every cell is placed and the Deferred fires
+    # after the last fragment.  tclass picks the data or
+    # control lanes; without classes everything is data.
+
+    @classmethod
+    def fill_async(cls, sender_id, msg, dest_id=None, doorbell=None,
+                   tclass=0):
+        msg = cls._validate(sender_id, msg)
+        return cls._enqueue(sender_id, msg, dest_id, 0, doorbell,
+                            tclass if cls.classes > 1 else 0)
+
+    @classmethod
+    def _enqueue(cls, sender_id, msg, dest_id, mask, doorbell, tclass=0):
+        lane = cls._lane(sender_id, dest_id, tclass)
+        key = (lane, dest_id)
+        if cls._messages.get(key, 0) >= cls.QUEUE_LIMIT:
+            return TIdefer.fail(RuntimeError(
+                'Queue from %d to %s is full' % (sender_id, dest_id)))
+        chunk = cls.MS_MAX_MSGLEN - 1       # Room for the NUL
+        if len(msg) <= chunk:
+            pieces = [ (msg, 0) ]
+        else:
+            count = -(-len(msg) // chunk)
+            assert count <= 0xFFFF, 'Message too long'
+            deaf = cls._cant_reassemble(dest_id, mask)
+            if deaf is not None:
+                return TIdefer.fail(ValueError(
+                    'Message of %d bytes is bigger than a cell (%d) and %s '
+                    'can\'t reassemble fragments' % (
+                        len(msg), chunk, deaf or 'an unknown receiver')))
+            fragid = cls._next_fragid.get(lane, 0) % 0xFFFFFFFF + 1
+            cls._next_fragid[lane] = fragid
+            view = memoryview(msg)
+            pieces = [ (view[i * chunk:(i + 1) * chunk],
+                        fragid << 32 | i << 16 | count)
+                       for i in range(count) ]
+        cls._messages[key] = cls._messages.get(key, 0) + 1
+        d = TIdefer.Deferred()
+        flows = cls._pending.setdefault(lane, {})
+        queue = flows.get(dest_id)
+        if queue is None:
+            queue = flows[dest_id] = deque()
+        if not queue:
+            active = cls._active.setdefault(lane, deque())
+            cls._deficit[(lane, dest_id)] = 0 if active else cls.MS_MAX_MSGLEN
+            active.append(dest_id)
+        for piece, frag in pieces[:-1]:
+            queue.append(
+                (sender_id, piece, dest_id, mask, frag, doorbell, None))
+        piece, frag = pieces[-1]
+        queue.append((sender_id, piece, dest_id, mask, frag, doorbell, d))
+        if lane not in cls._draining:
+            cls._draining.add(lane)
+            cls._drain_pending(
+                lane, NOW() + cls.FILL_TIMEOUT, cls.FILL_POLL_MIN)
+        return d
+
+    @classmethod
+    def _cant_reassemble(cls, dest_id, mask):
+        '''None if every receiver takes fragments, else a list of those
+           that don't (empty if the receiver isn't known).'''
+        receivers = [ D for D in range(mask.bit_length()) if mask >> D & 1 ]
+        if not mask:
+            receivers = [ dest_id ] if dest_id else []
+        deaf = [ D for D in receivers if not cls.can_reassemble(D) ]
+        return deaf if deaf or not receivers else None
+
+    @classmethod
+    def _next_queued(cls, lane):
+        '''Deficit round robin, a quantum of one full cell per turn.'''
+        active = cls._active[lane]
+        flows = cls._pending[lane]
+        while True:
+            dest_id = active[0]
+            key = (lane, dest_id)
+            queue = flows[dest_id]
+            size = len(queue[0][1] or b'')
+            if cls._deficit[key] < size and lane not in cls._midmsg:
+                active.rotate(-1)
+                cls._deficit[(lane, active[0])] += cls.MS_MAX_MSGLEN
+                continue
+            cls._deficit[key] -= size
+            entry = queue.popleft()
+            frag = entry[4]
+            if frag and (frag >> 16 & 0xFFFF) + 1 < frag & 0xFFFF:
+                cls._midmsg.add(lane)
+            else:
+                cls._midmsg.discard(lane)
+            if entry[6] is not None:    # Last (or only) cell of a message
+                cls._messages[key] -= 1
+            if not queue:
+                active.popleft()
+                del cls._deficit[key]
+                del cls._messages[key]
+                del flows[dest_id]
+                if active:
+                    cls._deficit[(lane, active[0])] += cls.MS_MAX_MSGLEN
+            if cls._messages.get(key, 0) <= cls.QUEUE_LOW:
+                for callback in cls._waiters.pop(
+                    (cls._sender(lane), dest_id), ()):
+                    TIreactor.callLater(0, callback)
+            return entry
+
+    @classmethod
+    def backlog(cls, sender_id, dest_id, tclass=0):
+        '''Messages queued from sender_id to dest_id.'''
+        return cls._messages.get(
+            (cls._lane(sender_id, dest_id, tclass), dest_id), 0)
+
+    @classmethod
+    def backlogs(cls, sender_id):
+        '''{ dest_id: messages queued } for the "dump" commands.'''
+        depths = {}
+        for (lane, dest_id), count in cls._messages.items():
+            if cls._sender(lane) == sender_id:
+                depths[dest_id] = depths.get(dest_id, 0) + count
+        return depths
+
+    @classmethod
+    def when_room(cls, sender_id, dest_id, callback):
+        '''callback() once the backlog is down to QUEUE_LOW.'''
+        if cls.backlog(sender_id, dest_id) <= cls.QUEUE_LOW:
+            TIreactor.callLater(0, callback)
+        else:
+            cls._waiters.setdefault((sender_id, dest_id), []).append(callback)
+
+    @classmethod
+    def drop_queued(cls, dest_id):
+        '''It left: forget everything still queued to it, and take it out
+           of multicast masks so its senders don't wait for its acks.'''
+        bit = 1 << dest_id
+        dropped = []
+        for lane, flows in cls._pending.items():
+            queue = flows.pop(dest_id, None)
+            if queue is not None:
+                if cls._active[lane][0] == dest_id:
+                    cls._midmsg.discard(lane)
+                cls._active[lane].remove(dest_id)
+                cls._deficit.pop((lane, dest_id), None)
+                cls._messages.pop((lane, dest_id), None)
+                dropped.extend(entry[6] for entry in queue
+                               if entry[6] is not None)
+            queue = flows.get(None, ())
+            for i, entry in enumerate(queue):
+                if entry[3] & bit:      # msg None: nobody left
+                    mask = entry[3] & ~bit
+                    queue[i] = (entry[0], entry[1] if mask else None,
+                                entry[2], mask) + entry[4:]
+        for key in [ k for k in cls._waiters if k[1] == dest_id ]:
+            del cls._waiters[key]
+        for d in dropped:
+            d.errback(RuntimeError('%d left before delivery' % dest_id))
+        for sender_id in list(cls._mcast_id):
+            for cell in cls._pending_cells(sender_id):
+                mask = _QUAD.unpack_from(cls.mm, cell + cls.MS_RCVMASK_off)[0]
+                if not mask & bit:
+                    continue
+                if mask == bit:
+                    _QUAD.pack_into(cls.mm, cell + cls.MS_MSGLEN_off, 0)
+                else:
+                    _QUAD.pack_into(cls.mm, cell + cls.MS_RCVMASK_off,
+                        mask & ~bit)
+            cls.released(sender_id)
+
+    @classmethod
+    def _drain_pending(cls, lane, stop, delay):
+        cls._retry.pop(lane, None)
+        while cls._active.get(lane):
+            if cls._slot_busy(lane):
+                if NOW() < stop:
+                    cls._retry[lane] = (TIreactor.callLater(delay,
+                        cls._drain_pending,
+                        lane, stop, min(delay * 2, cls.FILL_POLL_MAX)), stop)
+                    return
+                print('pseudo-HW not ready to receive timeout: now stomping')
+            sender_id, msg, dest_id, mask, frag, doorbell, d = \
+                cls._next_queued(lane)
+            if msg is not None:
+                cls._place(lane, msg, dest_id, frag, mask)
+                cls._doorbells(dest_id, mask, doorbell)
+            if d is not None:
+                d.callback(sender_id)
+            stop = NOW() + cls.FILL_TIMEOUT
+            delay = cls.FILL_POLL_MIN
+        cls._draining.discard(lane)
+
+    @classmethod
+    def _doorbells(cls, dest_id, mask, doorbell):
+        '''A multicast has a dict of them: ring whoever is still in the
+           mask.'''
+        if mask:
+            for D, ring in doorbell.items():
+                if mask >> D & 1 and not cls._hushed(D):
+                    ring()
+        elif doorbell is not None and not cls._hushed(dest_id):
+            doorbell()
+
+    #----------------------------------------------------------------------
+    # Multicast.  One copy in one cell for every destination that acks
+    # multicast, unicast fill_async() for the rest.  Needs the ack table
+    # and a single lane per sender (a matrix already gives every destination
+    # its own cell).  doorbells maps dest_id to its callable; a multicast's
+    # are rung back-to-back once the cell is placed.  The Deferred fires
+    # with sender_id when every destination has its copy.  tclass is as
+    # for fill_async().  A receiver that leaves is dropped from the mask
+    # (drop_queued()) rather than waited for.
+
+    @classmethod
+    def can_multicast(cls, id):
+        return bool(cls.ack_off and cls.lanes == 1 and
+                    cls._flags(id) & cls.FLAG_MCAST)
+
+    @classmethod
+    def _next_mcast_id(cls, sender_id, cell):
+        '''Ids must climb past any ack left by a previous incarnation.'''
+        last = cls._mcast_id.get(sender_id)
+        if last is None:
+            last = _QUAD.unpack_from(cls.mm, cell + cls.MS_MCAST_ID_off)[0]
+            for receiver_id in range(1, cls.MAILBOX_MAX_SLOTS):
+                last = max(last, _QUAD.unpack_from(cls.mm,
+                    cls._ack_index(receiver_id, sender_id))[0])
+        cls._mcast_id[sender_id] = last + 1
+        return last + 1
+
+    @classmethod
+    def fill_multicast(cls, sender_id, msg, doorbells, tclass=0):
+        msg = cls._validate(sender_id, msg)
+        tclass = tclass if cls.classes > 1 else 0
+        mcast = [ D for D in doorbells if cls.can_multicast(D) ]
+        if len(mcast) < 2:      # Nothing saved
+            mcast = []
+        deferreds = [ cls._enqueue(sender_id, msg, D, 0, doorbells[D], tclass)
+                      for D in doorbells if D not in mcast ]
+        if mcast:
+            deferreds.append(cls._enqueue(sender_id, msg, None,
+                sum(1 << D for D in mcast),
+                dict((D, doorbells[D]) for D in mcast), tclass))
+        d = TIdefer.gatherResults(deferreds, consumeErrors=True)
+        d.addCallback(lambda ignored: sender_id)
+        return d
+
+    #----------------------------------------------------------------------
+    # Release doorbell.  The owner of a mailslot sets FLAG_RELEASE, then any
+    # receiver that empties its cells rings its RELEASE_VECTOR and the
+    # owner's event callback calls released().  That retries the queued
+    # fills right away instead of at the end of the current poll delay.
+    # Polling stays as the fallback for receivers that don't ring.
+
+    @classmethod
+    def _flags(cls, id):
+        return _QUAD.unpack_from(
+            cls.mm, id * cls.MAILBOX_SLOTSIZE + cls.MS_FLAGS_off)[0]
+
+    @classmethod
+    def _set_flag(cls, id, flag, on):
+        flags = cls._flags(id)
+        flags = flags | flag if on else flags & ~flag
+        _QUAD.pack_into(cls.mm, id * cls.MAILBOX_SLOTSIZE + cls.MS_FLAGS_off,
+            flags)
+
+    @classmethod
+    def want_release(cls, id, on=True):
+        cls._set_flag(id, cls.FLAG_RELEASE, on)
+
+    @classmethod
+    def want_multicast(cls, id, on=True):
+        cls._set_flag(id, cls.FLAG_MCAST, on)
+
+    @classmethod
+    def want_fragments(cls, id, on=True):
+        cls._set_flag(id, cls.FLAG_FRAGMENTS, on)
+
+    @classmethod
+    def can_reassemble(cls, id):
+        return bool(cls._flags(id) & cls.FLAG_FRAGMENTS)
+
+    @classmethod
+    def wants_release(cls, id):
+        return bool(cls._flags(id) & cls.FLAG_RELEASE)
+
+    @classmethod
+    def can_suppress(cls):
+        return bool(cls.vectors or cls.ring_off)
+
+    # Each side of FLAG_NO_NOTIFY stores one word then loads another
+    # (owner: flag then cells; sender: cell then flag) and Python can't
+    # put a fence between them in shared memory.  x86 (TSO) only lets a
+    # load pass an earlier store, so the window is a store buffer drain;
+    # the poll() after unhushing in EventfdDispatcher.doRead() covers a
+    # sender that saw the old flag.  Weaker memory models aren't handled.
+
+    @classmethod
+    def suppress(cls, id, on=True):
+        '''Owner: set or clear FLAG_NO_NOTIFY on my mailslot.'''
+        cls._set_flag(id, cls.FLAG_NO_NOTIFY, on)
+
+    @classmethod
+    def _hushed(cls, dest_id):
+        '''Sender: skip the doorbell?  Only after the cell is placed.'''
+        if not dest_id:
+            return False
+        if cls._flags(dest_id) & cls.FLAG_NO_NOTIFY:
+            cls._count(dest_id, 'quiet')
+            return True
+        return False
+
+    @classmethod
+    def pending(cls, receiver_id):
+        '''(tclass, sender_id) with cells for receiver_id, control first.
+           For receivers that suppressed their doorbells.'''
+        return [ (tclass, sender_id) for tclass in cls._priority()
+                 for sender_id in range(1, cls.server_id + 1)
+                 if cls._pending_cells(sender_id, receiver_id, tclass) ]
+
+    @classmethod
+    def released(cls, sender_id):
+        for lane, (delayed, stop) in list(cls._retry.items()):
+            if cls._sender(lane) != sender_id:
+                continue
+            delayed.cancel()
+            cls._drain_pending(lane, stop, cls.FILL_POLL_MIN)
 
     #----------------------------------------------------------------------
     # Called by Python client on graceful shutdowns, and always by server
@@ -242,6 +1136,7 @@ class FAMEZ_MailBox(object):
         index = id * cls.MAILBOX_SLOTSIZE
         zeros = b'\0' * cls.MS_NODENAME_SIZE
         cls.mm[index:index + len(zeros)] = zeros
+        _QUAD.pack_into(cls.mm, index + cls.MS_FLAGS_off, 0)   # Next owner
         if nodenamebytes:
             assert len(nodenamebytes) < cls.MS_NODENAME_SIZE
             cls.mm[index:index + len(nodenamebytes)] = nodenamebytes
@@ -255,12 +1150,29 @@ class FAMEZ_MailBox(object):
         buf = os.fstat(cls.fd)
         assert STAT.S_ISREG(buf.st_mode), 'Mailbox FD is not a regular file'
         if cls.mm is None:
-            cls.mm = mmap.mmap(cls.fd, 0)
+            cls._map()
+            gflags = _QUAD.unpack_from(cls.mm, cls.G_FLAGS_off)[0]
+            if gflags & cls.GF_PREFAULT:    # Do it again, with feeling
+                cls.mm.close()
+                cls._map(prefault=True)
+            slotsize, nSlots = struct.unpack('QQ', cls.mm[
+                cls.G_SLOTSIZE_off:cls.G_SLOTSIZE_off + 8] + cls.mm[
+                cls.G_NSLOTS_off:cls.G_NSLOTS_off + 8])
+            cls._geometry(slotsize, nSlots or cls.MAILBOX_MAX_SLOTS)
             (cls.nClients,
              cls.nEvents,
-             cls.server_id) = struct.unpack(
-                'QQQ',
-                cls.mm[cls.G_NCLIENTS_off:cls.G_NCLIENTS_off + 24])
+             cls.server_id,
+             cls.depth,
+             cls.ring_off,
+             cls.cell_off,
+             cls.lanes) = struct.unpack(
+                'QQQQQQQ',
+                cls.mm[cls.G_NCLIENTS_off:cls.G_NCLIENTS_off + 56])
+            cls.ack_off, cls.vectors, cls.classes = struct.unpack_from(
+                'QQQ', cls.mm, cls.G_ACK_off)
+            cls.depth = max(cls.depth, 1)   # Older servers left them zero
+            cls.lanes = max(cls.lanes, 1)
+            cls.classes = max(cls.classes, 1)
 
         # mailbox slot starts with nodename
         cls.clear_mailslot(id, nodenamebytes=nodename.encode())
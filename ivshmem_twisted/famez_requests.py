@@ -5,11 +5,14 @@
 
 import os
 import functools
+import struct
 import sys
 
 from collections import OrderedDict
 from pprint import pprint
 
+from twisted.internet import reactor as TIreactor
+
 try:
     from famez_mailbox import FAMEZ_MailBox
 except ImportError as e:
@@ -19,8 +22,37 @@ PRINT = functools.partial(print, file=sys.stderr)
 PPRINT = functools.partial(pprint, stream=sys.stderr)
 
 ###########################################################################
-# Create a subroutine name out of the elements passed in.  Return
-# the remainder.  Start with the least-specific construct.
+# Handlers register their opcode words once into a prefix trie; a node
+# holds its handler under the None key.  chelsea() walks the elements
+# down the trie and returns the handler and the remainder.  Start with
+# the least-specific construct.  control=True sends that opcode's traffic
+# (requests and their responses) in the control class.
+
+_opcodes = {}
+
+_code2opcode = {}   # Binary opcode: (words, handler)
+_handler2code = {}
+
+
+_control = set()    # Handlers of control class traffic
+
+
+def opcode(*words, code=0, control=False):
+    def register(handler):
+        assert not any('=' in w for w in words), 'See _parse()'
+        node = _opcodes
+        for w in words:
+            node = node.setdefault(w, {})
+        assert None not in node, 'Duplicate opcode %s' % str(words)
+        node[None] = handler
+        if code:
+            assert code not in _code2opcode, 'Duplicate code %d' % code
+            _code2opcode[code] = (' '.join(words), handler)
+            _handler2code[handler] = code
+        if control:
+            _control.add(handler)
+        return handler
+    return register
 
 
 def _unprocessed(client, *args, **kwargs):
@@ -32,23 +64,49 @@ def _unprocessed(client, *args, **kwargs):
 
 
 def chelsea(elements, verbose=0):
-    entry = ''          # They begin with a leading '_', wait for it...
-    G = globals()
+    node = _opcodes
     for i, e in enumerate(elements):
-        e = e.replace('-', '_')         # Such as 'Link CTL Peer-Attribute'
-        entry += '_%s' % e
         if verbose > 1:
-            print('Looking for %s()...' % entry, end='', file=sys.stderr)
-        if entry in G:
+            print('Looking for %s...' % ' '.join(elements[:i + 1]),
+                end='', file=sys.stderr)
+        node = node.get(e)
+        if node is None:
+            break
+        if None in node:
             args = elements[i + 1:]
             if verbose > 1:
                 print('found it->%s' % str(args), file=sys.stderr)
-            return G[entry], args
+            return node[None], args
         if verbose > 1:
             print('NOPE', file=sys.stderr)
+    if verbose > 1:
+        print('NOPE', file=sys.stderr)
     return _unprocessed, elements
 
 ###########################################################################
+# The same opcodes come around over and over, so the trie walk is kept in
+# a bounded LRU cache.  It's keyed on the words before the first name=value
+# argument (no opcode word has an '='), not the whole payload: tags and
+# trackers would make nearly every payload unique.
+
+PARSE_CACHE = 256
+
+
+def _parse(payload):
+    words = payload.split()
+    for i, w in enumerate(words):
+        if '=' in w:
+            break
+    else:
+        i = len(words)
+    handler, args = _parse_prefix(tuple(words[:i]))
+    return handler, args + tuple(words[i:])
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE)
+def _parse_prefix(words):
+    handler, args = chelsea(list(words))
+    return handler, tuple(args)
 
 
 def CSV2dict(oneCSVstr):
@@ -62,6 +120,73 @@ def CSV2dict(oneCSVstr):
             continue
     return kv
 
+
+def parse_cache_info():
+    return { 'requests': _parse_prefix.cache_info() }
+
+###########################################################################
+# Binary form of a payload: a fixed header with the opcode, the sender's
+# SID/CID, tag, tracker and the length of the text that remains (the
+# arguments after the opcode words, or everything for code 0, which is
+# parsed like text on arrival).  The magic is not ASCII so the first byte
+# tells the forms apart.  Peers advertise Codec=binary in their
+# Peer-Attribute ACK; the text form is always understood and stays the
+# default, and it's what goes out when a field won't fit the header.
+
+_GZ_MAGIC = 0xFA
+_GZ_HDR = struct.Struct('<BBHHIIH')     # magic, opcode, SID, CID,
+                                        # tag, tracker, length
+CODEC_BINARY = 'binary'
+
+_binary_peers = set()   # Peer ids that negotiated binary with me
+
+
+def codec_attrs(responder):
+    '''Peer-Attribute addendum when this end speaks binary.'''
+    if getattr(responder.SI.args, 'binary', False):
+        return ',Codec=%s' % CODEC_BINARY
+    return ''
+
+
+def _negotiate(responder, peer_id):
+    if (getattr(responder.SI.args, 'binary', False) and
+        responder.peerattrs.get('Codec') == CODEC_BINARY):
+        _binary_peers.add(peer_id)
+    else:
+        _binary_peers.discard(peer_id)
+
+
+def encode(response, SID, CID, tag, tracker):
+    '''ValueError if a field is out of range for the header.'''
+    handler, args = _parse(response)
+    code = _handler2code.get(handler, 0)
+    body = (' '.join(args) if code else response).encode()
+    for name, value, limit in (('SID', SID, 0xFFFF), ('CID', CID, 0xFFFF),
+                               ('tag', tag, 0xFFFFFFFF),
+                               ('tracker', tracker, 0xFFFFFFFF),
+                               ('length', len(body), 0xFFFF)):
+        if not 0 <= value <= limit:
+            raise ValueError('binary %s %d is out of range' % (name, value))
+    return _GZ_HDR.pack(
+        _GZ_MAGIC, code, SID, CID, tag, tracker, len(body)) + body
+
+
+def _decode(request):
+    '''Returns (payload text for the trace, handler, args, tracker).  An
+       unknown opcode gets _unprocessed, ie, it's rejected.'''
+    _, code, SID, CID, tag, tracker, length = _GZ_HDR.unpack_from(request)
+    body = bytes(request[_GZ_HDR.size:_GZ_HDR.size + length]).decode()
+    if code:
+        words, handler = _code2opcode.get(code, ('', _unprocessed))
+        args = tuple(body.split())
+    else:
+        words = ''
+        handler, args = _parse(body)
+    if tag:     # Handlers find it with the other attributes
+        args = args[:-1] + ((args[-1] + ',' if args else '') + 'Tag=%d' % tag,)
+    payload = ' '.join(filter(None, (words, body)))
+    return payload, handler, args, tracker
+
 ###########################################################################
 # Here instead of famez_mailbox to manage the tag.  Can be called as a
 # "discussion initiator" usually from the REPL interpreters, or as a
@@ -69,69 +194,310 @@ def CSV2dict(oneCSVstr):
 
 _next_tag = 1               # Gen-Z tag field
 
-_tagged = OrderedDict()     # By tag, just store receiver now
-
 _tracker = 0                # FAME-Z addenda to watch client/server.py
 
 _TRACKER_TOKEN = '!FZT='
+_TRACKER_TOKEN_BYTES = _TRACKER_TOKEN.encode()
+
+###########################################################################
+# Outstanding tagged requests, per destination peer, at most TAG_CAPACITY
+# each (the oldest is dropped to make room).  Each one sits on a hashed
+# timer wheel: WHEEL_SLOTS buckets WHEEL_TICK seconds apart, with a rounds
+# count for anything more than one revolution out, so arming, cancelling
+# and expiring are all O(1).  The wheel only ticks while something is
+# armed.  On expiry RETRANSMIT opcodes are sent again with the same tag,
+# up to args.retries times, then forgotten.
+
+TAG_CAPACITY = 32
+TAG_TIMEOUT = 1.0           # seconds, args.tagtime (ms) overrides
+TAG_RETRIES = 2             # args.retries overrides
+RETRANSMIT = ('CTL-Write', )       # The only tagged requests
+
+_tagged = {}                # dest peer id: OrderedDict(tag: _Transaction)
+
+
+class _Transaction(object):
+
+    __slots__ = ('peer', 'sender_id', 'sender_EN', 'tclass', 'dest_id',
+                 'tag', 'response', 'afterACK', 'retries', 'bucket', 'rounds')
+
+    def __init__(self, peer, sender_id, sender_EN, tclass, dest_id,
+                 response, tag, afterACK):
+        self.peer = peer
+        self.sender_id = sender_id
+        self.sender_EN = sender_EN
+        self.tclass = tclass
+        self.dest_id = dest_id
+        self.tag = tag
+        self.response = response
+        self.afterACK = afterACK
+        self.retries = getattr(peer.SI.args, 'retries', TAG_RETRIES)
+        self.bucket = None
+        self.rounds = 0
+
+
+class _TimerWheel(object):
+
+    WHEEL_SLOTS = 64
+    WHEEL_TICK = 0.05
+
+    def __init__(self, expired):
+        self.expired = expired
+        self.buckets = [ set() for _ in range(self.WHEEL_SLOTS) ]
+        self.cursor = 0
+        self.armed = 0
+        self.ticker = None
+
+    def arm(self, txn, seconds):
+        ticks = max(1, int(round(seconds / self.WHEEL_TICK)))
+        txn.rounds, offset = divmod(ticks - 1, self.WHEEL_SLOTS)
+        txn.bucket = (self.cursor + 1 + offset) % self.WHEEL_SLOTS
+        self.buckets[txn.bucket].add(txn)
+        self.armed += 1
+        if self.ticker is None:
+            self.ticker = TIreactor.callLater(self.WHEEL_TICK, self._tick)
+
+    def cancel(self, txn):
+        if txn.bucket is not None:
+            self.buckets[txn.bucket].discard(txn)
+            txn.bucket = None
+            self.armed -= 1
+
+    def _tick(self):
+        self.ticker = None
+        self.cursor = (self.cursor + 1) % self.WHEEL_SLOTS
+        bucket = self.buckets[self.cursor]
+        due = [ txn for txn in bucket if not txn.rounds ]
+        for txn in bucket:
+            txn.rounds -= 1
+        for txn in due:
+            self.cancel(txn)
+            self.expired(txn)
+        if self.armed and self.ticker is None:
+            self.ticker = TIreactor.callLater(self.WHEEL_TICK, self._tick)
+
+
+def _timeout(peer):
+    return getattr(peer.SI.args, 'tagtime', TAG_TIMEOUT * 1000) / 1000.0
+
+
+def _expired(txn):
+    table = _tagged.get(txn.dest_id)
+    if table is None or table.get(txn.tag) is not txn:
+        return
+    if txn.retries and txn.response.startswith(RETRANSMIT):
+        txn.retries -= 1
+        txn.peer.SI.logmsg('Tag %d to %d timed out, retransmitting' % (
+            txn.tag, txn.dest_id))
+        _transmit(txn.peer, txn.sender_id, txn.sender_EN, txn.tclass,
+                  txn.dest_id, txn.response, txn.tag, False)
+        _wheel.arm(txn, _timeout(txn.peer))
+        return
+    del table[txn.tag]
+    txn.peer.SI.logmsg('Tag %d to %d expired' % (txn.tag, txn.dest_id))
+
+
+_wheel = _TimerWheel(_expired)
+
+
+def _tag(peer, sender_id, sender_EN, tclass, dest_id, response, tag):
+    global _next_tag
+
+    txn = _Transaction(peer, sender_id, sender_EN, tclass, dest_id, response,
+                       _next_tag, CSV2dict(tag).get('AfterACK', False))
+    _next_tag += 1
+    table = _tagged.setdefault(txn.dest_id, OrderedDict())
+    if len(table) >= TAG_CAPACITY:
+        _, oldest = table.popitem(last=False)
+        _wheel.cancel(oldest)
+        peer.SI.logmsg('Tag table for %d full, dropped tag %d' % (
+            txn.dest_id, oldest.tag))
+    table[txn.tag] = txn
+    _wheel.arm(txn, _timeout(peer))
+    return txn.tag
+
+
+def _untag(dest_id, tag):
+    '''Returns the _Transaction or None.'''
+    txn = _tagged.get(dest_id, {}).pop(tag, None)
+    if txn is not None:
+        _wheel.cancel(txn)
+    return txn
+
+
+def forget_peer(peer_id):
+    '''It left: drop its codec and anything still waiting on it.'''
+    _binary_peers.discard(peer_id)
+    for txn in _tagged.pop(peer_id, {}).values():
+        _wheel.cancel(txn)
+
+
+def tag_info():
+    return dict((id, len(table)) for id, table in _tagged.items() if table)
+
+###########################################################################
+
 
 def send_payload(peer, response,
-        sender_id=None, sender_EN=None, tag=None, reset_tracker=False):
-    global _next_tag, _tracker
+        sender_id=None, sender_EN=None, tag=None, reset_tracker=False,
+        dest_id=None):
 
+    tclass = traffic_class(response)
     if sender_id is None:   # Not currently used, responder_id is pre-filled
         sender_id = peer.responder_id
     if sender_EN is None:   # Ditto
-        sender_EN = peer.responder_EN
+        sender_EN = peer.class_EN(tclass)
+    if dest_id is None:     # Whoever sent the request being answered
+        dest_id = peer.requester_id
+    tagnum = 0
     if tag is not None:     # zero-length string can trigger this
-        response += ',Tag=%d' % _next_tag
-        _tagged[str(_next_tag)] = '%d.%d!%s|%s' % (
-            peer.SID0, peer.CID0, response, tag)
-        _next_tag += 1
+        tagnum = _tag(peer, sender_id, sender_EN, tclass, dest_id,
+                      response, tag)
+    return _transmit(peer, sender_id, sender_EN, tclass, dest_id,
+                     response, tagnum, reset_tracker)
+
+
+def traffic_class(response):
+    handler, _ = _parse(response)
+    if handler in _control:
+        return FAMEZ_MailBox.TC_CONTROL
+    return FAMEZ_MailBox.TC_DATA
+
+
+def _transmit(peer, sender_id, sender_EN, tclass, dest_id, response,
+              tagnum, reset_tracker):
+    tracker = _next_tracker(reset_tracker)
+    msg = None
+    if dest_id in _binary_peers:
+        SID0, CID0 = _my_SID_CID(peer)
+        try:
+            msg = encode(response, SID0, CID0, tagnum, tracker)
+        except ValueError as e:
+            peer.SI.logmsg('%s, sending text' % str(e))
+    if msg is None:
+        if tagnum:
+            response += ',Tag=%d' % tagnum
+        msg = response + '%s%d' % (_TRACKER_TOKEN, tracker)
+
+    # Don't block the reactor waiting for the previous responder; ring
+    # the doorbell once the mailslot actually holds (each fragment of)
+    # this response.
+    d = FAMEZ_MailBox.fill_async(sender_id, msg, dest_id,
+        doorbell=sender_EN.incr, tclass=tclass)
+    d.addErrback(_unsent, peer, dest_id)
+    return d
+
+
+def _unsent(failure, peer, dest_id):
+    '''Full queue, or the destination left.'''
+    peer.SI.logmsg('Not sent to %s: %s' % (
+        dest_id, failure.getErrorMessage()))
+
+
+def _next_tracker(reset_tracker):
+    global _tracker
 
-    # Put the tracker on the end where it's easier to find
     if reset_tracker:
         _tracker = 0
     _tracker += 1
-    response += '%s%d' % (_TRACKER_TOKEN, _tracker)
+    return _tracker
+
+
+def _track(response, reset_tracker):
+    # Put the tracker on the end where it's easier to find
+    return response + '%s%d' % (_TRACKER_TOKEN, _next_tracker(reset_tracker))
+
 
-    FAMEZ_MailBox.fill(sender_id, response)
-    sender_EN.incr()
-    return True     # FIXME: is there anything to detect?
+def send_multicast(sender_id, response, doorbells, reset_tracker=False):
+    '''One response (one tracker) to every dest_id key of doorbells.
+       Always text: the cell is shared by receivers of either codec.'''
+    return FAMEZ_MailBox.fill_multicast(sender_id,
+        _track(response, reset_tracker), doorbells,
+        tclass=traffic_class(response))
+
+
+def _my_SID_CID(responder):
+    if getattr(responder.SI, 'isPFM', None) is None:
+        return responder.SID0, responder.CID0
+    return responder.SI.server_SID0, responder.SI.server_CID0
 
 ###########################################################################
 # Gen-Z 1.0 "6.8 Standalone Acknowledgment"
-# Received by server/switch
+# Received by server/switch.  Acknowledgments for one requester are held
+# until the end of the reactor turn (ie, the rest of the drained batch)
+# and then go out as one message: a single tag is "Tag=N" as always, more
+# are "Tags=" with "+"-separated numbers and "lo-hi" ranges (commas are
+# taken by CSV), eg, "Tags=3-7+9,Reason=OK".
 
 
+@opcode('Standalone', 'Acknowledgment', code=1, control=True)
 def _Standalone_Acknowledgment(responder, args):
-    retval = True
-    tag = False
     try:
         kv = CSV2dict(args[0])
-        stamp, tag = _tagged[kv['Tag']].split('|')
-        del _tagged[kv['Tag']]
-        tag = tag.strip()
-        kv = CSV2dict(tag)
-    except KeyError as e:
-        responder.SI.trace('UNTAGGING %d:%s FAILED' %
-            (responder.responder_id, responder.nodename))
-        retval = False
-        kv = {}
-
-    afterACK = kv.get('AfterACK', False)
-    if afterACK:
-        send_payload(responder, afterACK)
-
-    if _tagged:
-        print('Outstanding tags:', file=sys.stderr)
-        pprint(_tagged, stream=sys.stderr)
+        tags = _tag_list(kv['Tags']) if 'Tags' in kv else (int(kv['Tag']),)
+    except (IndexError, KeyError, ValueError) as e:
+        tags = ()
+    retval = bool(tags)
+    for tag in tags:
+        txn = _untag(responder.requester_id, tag)
+        if txn is None:     # Never sent, long gone, or a retransmission's ACK
+            responder.SI.trace('UNTAGGING %d:%s TAG %d FAILED' %
+                (responder.responder_id, responder.nodename, tag))
+            retval = False
+        elif txn.afterACK:
+            send_payload(responder, txn.afterACK)
+
+    if responder.SI.args.verbose > 1:
+        PRINT('Outstanding tags by peer: %s' % tag_info())
     return retval
 
 
+def _tag_list(spec):
+    tags = []
+    for r in spec.split('+'):
+        lo, _, hi = r.partition('-')
+        tags.extend(range(int(lo), int(hi or lo) + 1))
+    return tags
+
+
+def _tag_ranges(tags):
+    ranges = []
+    lo = hi = None
+    for tag in sorted(tags) + [None]:
+        if hi is not None and tag == hi + 1:
+            hi = tag
+            continue
+        if lo is not None:
+            ranges.append('%d-%d' % (lo, hi) if hi > lo else '%d' % lo)
+        lo = hi = tag
+    return '+'.join(ranges)
+
+
+_pending_SA = OrderedDict()     # (requester id, reason): [responder, tags]
+
+
 def _send_SA(responder, tag, reason):
-    response = 'Standalone Acknowledgment Tag=%s,Reason=%s' % (tag, reason)
-    return send_payload(responder, response)
+    key = (responder.requester_id, reason)
+    if not _pending_SA:
+        TIreactor.callLater(0, _flush_SA)
+    _pending_SA.setdefault(key, [responder, []])[1].append(int(tag))
+    return True
+
+
+def _flush_SA():
+    while _pending_SA:
+        (requester_id, reason), (responder, tags) = _pending_SA.popitem(
+            last=False)
+        if len(tags) == 1:
+            response = 'Standalone Acknowledgment Tag=%d,Reason=%s' % (
+                tags[0], reason)
+        else:
+            response = 'Standalone Acknowledgment Tags=%s,Reason=%s' % (
+                _tag_ranges(tags), reason)
+        try:    # requester_id on the responder may have moved on
+            send_payload(responder, response, dest_id=requester_id)
+        except Exception as e:
+            responder.SI.logmsg('SA to %d failed: %s' % (requester_id, str(e)))
 
 ###########################################################################
 # Gen-Z 1.0 "11.11 Link CTL" subfield
@@ -150,6 +516,7 @@ def send_LinkACK(responder, details, nack=False):
 # Received by client, only really expecting RFC data
 
 
+@opcode('CTL-Write', code=2, control=True)
 def _CTL_Write(responder, args):
     kv = CSV2dict(args[0])
     if int(kv['Space']) != 0:
@@ -164,6 +531,7 @@ def _CTL_Write(responder, args):
 # Received by switch
 
 
+@opcode('Link', 'RFC', code=3, control=True)
 def _Link_RFC(responder, args):
     if not responder.SI.args.smart:
         responder.SI.logmsg('I am not a manager')
@@ -187,25 +555,22 @@ def _Link_RFC(responder, args):
 # Gen-Z 1.0 "11.11 Link CTL"
 # Entered on both client and server responses.
 
+@opcode('Link', 'CTL', code=4, control=True)
 def _Link_CTL(responder, args):
     '''Subelements should be empty.'''
     arg0 = args[0] if len(args) else ''
     if len(args) == 1:
         if arg0 == 'Peer-Attribute':
-            if getattr(responder.SI, 'isPFM', None) is None:
-                SID0 = responder.SID0
-                CID0 = responder.CID0
-            else:
-                SID0 = responder.SI.server_SID0
-                CID0 = responder.SI.server_CID0
-            attrs = 'C-Class=%s,SID0=%d,CID0=%d' % (
-                responder.SI.C_Class, SID0, CID0)
+            SID0, CID0 = _my_SID_CID(responder)
+            attrs = 'C-Class=%s,SID0=%d,CID0=%d%s' % (
+                responder.SI.C_Class, SID0, CID0, codec_attrs(responder))
             return send_LinkACK(responder, attrs)
 
     if arg0 == 'ACK' and len(args) == 2:
         # FIXME: correlation ala _tagged?  How do I know it's peer attrs?
         # FIXME: add a key to the response...
         responder.peerattrs = CSV2dict(args[1])
+        _negotiate(responder, responder.requester_id)
         return True
 
     if arg0 == 'NAK':
@@ -220,31 +585,48 @@ def _Link_CTL(responder, args):
 # Finally a home
 
 
+@opcode('ping', code=5)
 def _ping(responder, args):
     return send_payload(responder, 'pong')
 
 ###########################################################################
 # Chained from actual EventReader callback in twisted_server.py.
 # Commands streams are case-sensitive, read the spec.
-# Return True if successfully parsed and processed.
+# Return True if successfully parsed and processed.  The request can come
+# straight out of FAMEZ_MailBox.drain() as bytes: the tracker is split off
+# without decoding, then only the payload is decoded, once.  A binary
+# request is one unpack_from.
 
 
 def handle_request(request, requester_name, responder):
     global _tracker
 
-    elements = request.split(_TRACKER_TOKEN)
-    payload = elements.pop(0)
+    handler = None
+    if isinstance(request, str):
+        payload, token, FTZ = request.partition(_TRACKER_TOKEN)
+    elif request and request[0] == _GZ_MAGIC:
+        payload, handler, args, FTZ = _decode(request)
+        token = True
+    else:
+        payload, token, FTZ = bytes(request).partition(_TRACKER_TOKEN_BYTES)
+        payload = payload.decode()
     trace = '\n%10s@%d->"%s"' % (
         requester_name, responder.requester_id, payload)
-    FTZ = int(elements[0]) if elements else False
+    FTZ = int(FTZ) if token else False
     if FTZ:
         trace += ' (%d)' % FTZ
         _tracker = FTZ
+    if handler is not None:
+        trace += ' [%s]' % CODEC_BINARY
     responder.SI.trace(trace)
 
-    elements = payload.split()
     try:
-        handler, args = chelsea(elements, responder.SI.args.verbose)
+        if handler is not None:
+            pass
+        elif responder.SI.args.verbose > 1:     # Show the walk, skip cache
+            handler, args = chelsea(payload.split(), responder.SI.args.verbose)
+        else:
+            handler, args = _parse(payload)
         return handler(responder, args)
     except KeyError as e:
         responder.SI.logmsg('KeyError: %s' % str(e))
@@ -5,9 +5,10 @@
 
 ###########################################################################
 
+import resource
 import sys
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 
 
 class ServerInvariant(object):
@@ -16,6 +17,7 @@ class ServerInvariant(object):
         if args is None:        # Called from client, filled in gradually
             self.nClients = 0   # Total peers including me, excluding server
             self.nEvents = 0
+            self.nVectors = 0   # Per peer: nEvents, or fewer if compact
             self.server_id = 0
             self.logmsg = print
             self.logerr = print
@@ -29,7 +31,14 @@ class ServerInvariant(object):
         self.nClients = args.nClients
         self.server_id = args.nClients + 1  # This is me!
         self.nEvents = args.nClients + 2
+        self.nVectors = args.nVectors
         self.clients = OrderedDict()        # Order probably not necessary
+        self.joining = OrderedDict()        # Order IS necessary, see server
+        self.adverts = []                   # Prepacked server eventfds
+        self.join_pump = None               # DelayedCall advancing joins
+        self.EN_pool = deque()              # Spare client eventfd sets
+        self.EN_refill = None               # DelayedCall
+        self.throttled = set()              # Requesters held for backlog
         self.recycled = {}
         if args.smart:
             self.default_SID = 27
@@ -44,3 +53,38 @@ class ServerInvariant(object):
 
     def trace(self, tracemsg):
         print(tracemsg, file=self.stdtrace)
+
+###########################################################################
+# Every process holds an eventfd per vector of every peer it can ring.
+# Roughly: the server has its own set plus one set per client id (active
+# or pooled) and a socket each; a client has a set per peer including the
+# server and itself.  SLACK covers stdio, the mailbox, epoll and friends.
+
+FD_SLACK = 16
+
+
+def fd_budget(nClients, nVectors):
+    '''(server, client) file descriptor estimates.'''
+    peers = (nClients + 1) * nVectors
+    return peers + nClients + FD_SLACK, peers + FD_SLACK
+
+
+def check_fd_budget(needed, who, logmsg=print):
+    '''Report needed against RLIMIT_NOFILE, raising the soft limit toward
+       the hard one if that's enough.  Returns False if it won't fit.'''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    logmsg('%s fd budget %d, limit %d (hard %s)' % (
+        who, needed, soft, 'unlimited' if hard == resource.RLIM_INFINITY
+                                       else hard))
+    if needed <= soft:
+        return True
+    if hard == resource.RLIM_INFINITY or needed <= hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+            logmsg('Raised %s fd limit to %d' % (who, needed))
+            return True
+        except Exception as e:
+            pass
+    logmsg('%s needs %d fds but may only open %d; fewer clients or compact '
+           'vectors' % (who, needed, soft))
+    return False
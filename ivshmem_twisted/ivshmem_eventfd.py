@@ -13,8 +13,14 @@
 
 import errno
 import os
+import select
 import struct
 import sys
+import tempfile
+from collections import OrderedDict
+from time import perf_counter
+
+from os.path import stat as STAT    # for constants
 
 from twisted.internet import reactor as TIreactor   # should be same everywhere
 from twisted.internet.interfaces import IReadDescriptor
@@ -26,7 +32,48 @@ from zope.interface import implementer
 # the ones used by ivshmem-server.c are recreated here.  Also see
 # https://sgros-students.blogspot.com/2013/05/calling-eventfd-from-python.html
 
-from ctypes import cdll
+# How a new notifier fd gets made is a backend, picked at runtime:
+#   os      os.eventfd() (Python 3.10+)
+#   ctypes  eventfd() straight out of libc, loaded on first use
+#   pipe    a FIFO opened read/write and unlinked: one fd that can be both
+#           read and written like an eventfd (QEMU's fallback reads pipes)
+# Reading and writing are plain os calls either way.  Received fds are
+# checked for being a FIFO so a peer needn't know the creator's choice.
+# See "docs/experiments/02 notifier bench.py" for comparing them.
+
+_libc = None
+
+def _new_os(init_val, flags):
+    return os.eventfd(init_val, flags)
+
+def _new_ctypes(init_val, flags):
+    global _libc
+    if _libc is None:
+        from ctypes import cdll
+        _libc = cdll.LoadLibrary('libc.so.6')
+    return _libc.eventfd(init_val, flags)
+
+def _new_pipe(init_val, flags):
+    tmpdir = tempfile.mkdtemp(prefix='famez_')
+    path = os.path.join(tmpdir, 'notifier')
+    try:
+        os.mkfifo(path, 0o600)
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK | os.O_CLOEXEC)
+    finally:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            pass
+        os.rmdir(tmpdir)
+    if init_val:
+        os.write(fd, struct.pack('Q', init_val))
+    return fd
+
+NOTIFIER_BACKENDS = OrderedDict((
+    ('os', _new_os),
+    ('ctypes', _new_ctypes),
+    ('pipe', _new_pipe),
+))
 
 class IVSHMEM_Event_Notifier(object):  # Probably overkill
 
@@ -35,16 +82,25 @@ class IVSHMEM_Event_Notifier(object):  # Probably overkill
     EFD_CLOEXEC =   0o02000000
     EFD_NONBLOCK =  0o00004000
 
-    _libc = cdll.LoadLibrary('libc.so.6')
+    backend = 'os' if hasattr(os, 'eventfd') else 'ctypes'
+
+    @classmethod
+    def use_backend(cls, name):
+        assert name in NOTIFIER_BACKENDS, 'Unknown notifier "%s"' % name
+        if name == 'os':
+            assert hasattr(os, 'eventfd'), 'os.eventfd needs Python 3.10'
+        cls.backend = name
 
     def __init__(self, init_val=0, active=False, valid_eventfd = -1):
         '''valid_eventfd is from client; server always makes a new one.'''
         self.cbdata = None
         if valid_eventfd >= 0:
             self.rfd = self.wfd = valid_eventfd
+            self.ispipe = STAT.S_ISFIFO(os.fstat(valid_eventfd).st_mode)
             return
-        self.rfd = self.wfd = self._libc.eventfd(
-            init_val, self.EFD_NONBLOCK | self.EFD_CLOEXEC)
+        flags = self.EFD_NONBLOCK | self.EFD_CLOEXEC
+        self.ispipe = self.backend == 'pipe'
+        self.rfd = self.wfd = NOTIFIER_BACKENDS[self.backend](init_val, flags)
         assert self.rfd >= 0, 'eventfd() failed'
         if active:
             self.incr()
@@ -67,12 +123,17 @@ class IVSHMEM_Event_Notifier(object):  # Probably overkill
                 raise
 
     def reset(self):
-        '''Without EFD_SEMAPHORE, reset if non-zero, else EAGAIN (NONBLOCK).'''
+        '''Without EFD_SEMAPHORE, reset if non-zero, else EAGAIN (NONBLOCK).
+           Returns (fired, count).'''
         while True:
             try:
+                if self.ispipe:     # Sum the quadword from each incr()
+                    junk = os.read(self.rfd, 4096)
+                    return bool(junk), sum(
+                        q for q, in struct.iter_unpack('Q', junk))
                 junk = os.read(self.rfd, 8)    # reset
                 if len(junk) == 8:
-                    return True, struct.unpack('Q', junk)
+                    return True, struct.unpack('Q', junk)[0]
                 return False, None
             except InterruptedError as e:      # handled interally at 3.5
                 continue
@@ -127,11 +188,15 @@ class EventfdReader(object):
     def logPrefix(self):
         return 'ServerEvent@%d' % self.fileno()
 
+    # Kicks that arrive before the reactor wakes up are summed by the
+    # eventfd, so the callback gets that count.
+
     def doRead(self):
-        fired, value = self.eventobj.reset()
-        if fired:
-            self.eventobj.last_value = value
-            self.callback(self.eventobj)
+        fired, count = self.eventobj.reset()
+        if not fired:
+            return
+        self.eventobj.last_value = count
+        self.callback(self.eventobj, count)
 
     def connectionLost(self, reason):
         TIreactor.removeReader(self)  # Paranoid?  EAGAIN?  Use destroy()?
@@ -148,3 +213,111 @@ class EventfdReader(object):
         TIreactor.removeReader(self)
         self.loseConnection()
 
+
+###########################################################################
+# One IReadDescriptor for a whole set of eventfds: the reactor watches a
+# single epoll fd, and each wakeup collects every ready vector with one
+# epoll_wait, then calls back in vector order with the same (eventobj,
+# count) signature as EventfdReader.  Level-triggered; reset() empties it.
+# With spin (microseconds) it keeps polling the set without blocking for
+# that long after each batch, so a quick answer (ping-pong) skips the trip
+# back through the reactor.  The reactor is starved while spinning, so the
+# window restarts after a hit but the whole spin is capped at SPIN_LIMIT.
+
+
+@implementer(IReadDescriptor)
+class EventfdDispatcher(object):
+
+    SPIN_LIMIT = 0.1        # seconds
+
+    def __init__(self, spin=0, hush=None, poll=None):
+        '''hush(on) tells senders not to bother ringing while a batch is
+           handled; poll() then delivers whatever arrived anyway and
+           returns how much.  Both or neither.'''
+        self.epoll = select.epoll()
+        self.readers = {}   # fd: (eventobj, callback)
+        self.spin = spin / 1000000.0
+        self.hush = hush
+        self.poll = poll if hush is not None else None
+        if spin and (os.cpu_count() or 1) < 2:
+            print('Spinning on one CPU only delays the sender', file=sys.stderr)
+
+    def add(self, eventobj, callback, cbdata):
+        assert isinstance(eventobj, IVSHMEM_Event_Notifier), 'Bad object'
+        eventobj.cbdata = cbdata
+        eventobj.last_value = None
+        fd = eventobj.get_fd()
+        self.readers[fd] = (eventobj, callback)
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove(self, eventobj):
+        fd = eventobj.get_fd()
+        if self.readers.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def fileno(self):
+        return self.epoll.fileno()
+
+    def logPrefix(self):
+        return 'EventDispatch@%d' % self.fileno()
+
+    def doRead(self):
+        if self.hush is None:
+            if self._dispatch() and self.spin:
+                self._spin(self._dispatch)
+            return
+
+        # Doorbells are suppressed while hushed so spin on the mailbox
+        # too.  After unhushing, one more look catches anything posted
+        # by a sender that still saw the flag.
+        def both():
+            return self._dispatch() + self.poll()
+
+        self.hush(True)
+        found = self._dispatch()
+        while True:
+            if found and self.spin:
+                self._spin(both)
+            self.hush(False)
+            found = self.poll()
+            if not found:
+                return
+            self.hush(True)
+
+    def _spin(self, work):
+        now = perf_counter()
+        stop, limit = now + self.spin, now + self.SPIN_LIMIT
+        while now < stop:
+            if work():
+                stop = min(perf_counter() + self.spin, limit)
+            now = perf_counter()
+
+    def _dispatch(self):
+        '''Callback for everything ready now, return how many.'''
+        batch = []
+        for fd, _ in self.epoll.poll(0, len(self.readers) or 1):
+            eventobj, callback = self.readers[fd]
+            fired, count = eventobj.reset()
+            if fired:
+                eventobj.last_value = count
+                batch.append((getattr(eventobj, 'num', fd), eventobj,
+                    callback, count))
+        for _, eventobj, callback, count in sorted(batch, key=lambda b: b[0]):
+            callback(eventobj, count)
+        return len(batch)
+
+    def connectionLost(self, reason):
+        TIreactor.removeReader(self)
+        for eventobj, _ in self.readers.values():
+            eventobj.cleanup()
+        self.readers = {}
+        self.epoll.close()
+
+    def start(self):
+        '''Convenience, not in twisted classes.'''
+        TIreactor.addReader(self)
+
+    def destroy(self):
+        '''Convenience, not in twisted classes.'''
+        TIreactor.removeReader(self)
+        self.epoll.close()
@@ -18,24 +18,36 @@ import sys
 ###########################################################################
 
 
-def ivshmem_send_one_msg(thesocket, data, fd=None):
+_QUAD = struct.Struct('q')
+_FD = struct.Struct('i')
+
+
+def ivshmem_pack_one_msg(data, fd=None):
+    '''Build the sendmsg() arguments once so they can be reused, ie, for
+       advertising the same (id, fd) to every peer that joins.'''
     # On the far side, if no fd is received from here, a helper routine
     # returns fd == -1 which is checked in various places.
-    data = int(data)
-    bdata_iovec = [ struct.pack('q', data) ]    # One item in the vector
+    bdata_iovec = [ _QUAD.pack(int(data)) ]     # One item in the vector
     if fd is None:
         cmsg = []   # Message array of none, defaults to fd == -1 on far side.
     else:
-        fd = int(fd)
         cmsg = [    # Message array of one.
-            (socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('i', fd))
+            (socket.SOL_SOCKET, socket.SCM_RIGHTS, _FD.pack(int(fd)))
         ]
+    return bdata_iovec, cmsg
+
+
+def ivshmem_send_packed(thesocket, packed):
     try:
-        ret = thesocket.sendmsg(bdata_iovec, cmsg)
+        ret = thesocket.sendmsg(*packed)
     except Exception as e:
         ret = -1
     return ret == 8
 
 
+def ivshmem_send_one_msg(thesocket, data, fd=None):
+    return ivshmem_send_packed(thesocket, ivshmem_pack_one_msg(data, fd))
+
+
 def ivshmem_recv_one_msg(thesocket):
     print(thesocket.recvmsg(64, 64))
@@ -7,6 +7,7 @@
 # Rocky Craig <rocky.craig@hpe.com>
 
 import argparse
+import functools
 import grp
 import mmap
 import struct
@@ -30,15 +31,21 @@ from zope.interface import implementer
 try:
     from commander import Commander
     from famez_mailbox import FAMEZ_MailBox
-    from famez_requests import handle_request, send_payload
-    from general import ServerInvariant
-    from ivshmem_eventfd import ivshmem_event_notifier_list, EventfdReader
+    from famez_requests import (
+        handle_request, send_payload, send_multicast, forget_peer,
+        traffic_class)
+    from general import ServerInvariant, fd_budget, check_fd_budget
+    from ivshmem_eventfd import ivshmem_event_notifier_list, EventfdDispatcher
 except ImportError as e:
     from .commander import Commander
     from .famez_mailbox import FAMEZ_MailBox
-    from .famez_requests import handle_request, send_payload
-    from .general import ServerInvariant
-    from .ivshmem_eventfd import ivshmem_event_notifier_list, EventfdReader
+    from .famez_requests import (
+        handle_request, send_payload, send_multicast, forget_peer,
+        traffic_class)
+    from .general import ServerInvariant, fd_budget, check_fd_budget
+    from .ivshmem_eventfd import ivshmem_event_notifier_list, EventfdDispatcher
+
+_QUAD = struct.Struct('q')      # IVSHMEM protocol datum, signed
 
 ###########################################################################
 # See qemu/docs/specs/ivshmem-spec.txt::Client-Server protocol and
@@ -53,10 +60,9 @@ except ImportError as e:
 # is recognized as implementing IFileDescriptorReceiver, it will FIRST
 # call fileDescriptorReceived before dataReceived.  So for the initial
 # info exchange, version and my (new) id are put out without an fd,
-# then a -1 is put out with the mailbox fd.   What triggers here is
-# one fileDescriptorReceived, THEN a dataReceived of thre quad words.
-# Then it pingpongs evenly between an fd and a single quadword for
-# each grouping.
+# then a -1 is put out with the mailbox fd.  Then it's a stream of
+# quadwords, each grouping with an fd.  How those get chopped up into
+# reads is not guaranteed so it's reframed here; see dataReceived().
 
 
 @implementer(IFileDescriptorReceiver)   # Energizes fileDescriptorReceived
@@ -67,6 +73,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
     SI = None
     id2fd_list = OrderedDict()     # Sent to me for each peer
     id2EN_list = OrderedDict()     # Generated from fd_list
+    id2nodename = OrderedDict()    # Refreshed by get_nodenames()
 
     def __init__(self, cmdlineargs):
         try:                    # twisted causes blindness
@@ -85,7 +92,11 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             # The state machine major decisions about the semantics of blocks
             # of data have one predicate.   While technically unecessary,
             # firstpass guards against server coding errors.
-            self._latest_fd = None
+            self._inbuf = bytearray()   # See dataReceived()
+            self._chunk_fds = []
+            self._quad_fds = {}         # quadword number: fd
+            self._nquads = 0
+            self._initial = []
             self.firstpass = True
         except Exception as e:
             print('__init__() failed: %s' % str(e))
@@ -99,8 +110,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
     def get_nodenames(cls):
         cls.id2nodename = OrderedDict()
         for peer_id in sorted(cls.id2fd_list):  # keys() are integer IDs
-            nodename, _ = FAMEZ_MailBox.retrieve(peer_id, clear=False)
-            cls.id2nodename[peer_id] = nodename
+            cls.id2nodename[peer_id] = FAMEZ_MailBox._nodename(peer_id)
 
     def parse_target(self, instr):
         '''Return a list even for one item for consistency with keywords
@@ -142,13 +152,15 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         assert src_indices, 'missing or unknown source(s)'
         assert dest_indices, 'missing or unknown destination(s)'
         for S in src_indices:
+            if len(dest_indices) > 1:
+                self._multicast(dest_indices, msg, S, reset_tracker)
+                continue
             for D in dest_indices:
                 if self.SI.args.verbose > 1:
                     print('P&G(%s, "%s", %s)' % (D, msg, S))
                 try:
                     self.requester_id = D
                     self.responder_id = S
-                    # Yes it repeat-loads a mailslot D times but who cares
                     send_payload(self, msg, reset_tracker=reset_tracker)
                 except KeyError as e:
                     print('No such peer id', str(e))
@@ -158,30 +170,59 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                         (D, msg, S, str(e)))
                     return
 
-    def fileDescriptorReceived(self, latest_fd):
-        assert self._latest_fd is None, 'Latest fd has not been consumed'
-        self._latest_fd = latest_fd     # See the next property
+    def _multicast(self, dest_indices, msg, S, reset_tracker):
+        '''Load the mailslot once for all destinations that can take it.'''
+        doorbells = OrderedDict()
+        vector = FAMEZ_MailBox.vector(S, traffic_class(msg))
+        for D in dest_indices:
+            try:
+                doorbells[D] = self.id2EN_list[D][vector].incr
+            except KeyError as e:
+                print('No such peer id', str(e))
+        if not doorbells:
+            return
+        if self.SI.args.verbose > 1:
+            print('P&G multicast(%s, "%s", %s)' % (list(doorbells), msg, S))
+        try:
+            send_multicast(S, msg, doorbells, reset_tracker=reset_tracker)
+        except Exception as e:
+            print('place_and_go(%s, "%s", %s) failed: %s' %
+                (list(doorbells), msg, S, str(e)))
 
-    @property
-    def latest_fd(self):
-        '''This is NOT idempotent!'''
-        tmp = self._latest_fd
-        self._latest_fd = None
-        return tmp
+    # Framing.  The server sends one quadword per sendmsg(), some with an
+    # fd, but the stream can hand over several quadwords (or part of one)
+    # per read.  Linux ends a read after a message that carries fds, so an
+    # fd belongs to the quadword holding the last byte of the chunk it
+    # arrived with.  Whole (quadword, fd or None) records go to
+    # recordReceived().
+
+    def fileDescriptorReceived(self, latest_fd):
+        self._chunk_fds.append(latest_fd)   # Always before dataReceived
 
-    def retrieve_initial_info(self, data):
+    def dataReceived(self, data):
+        self._inbuf += data
+        if self._chunk_fds:
+            last = self._nquads + (len(self._inbuf) - 1) // 8
+            for i, fd in enumerate(reversed(self._chunk_fds)):
+                self._quad_fds[last - i] = fd
+            self._chunk_fds = []
+        nquads = len(self._inbuf) // 8
+        records = [ (_QUAD.unpack_from(self._inbuf, i * 8)[0],
+                     self._quad_fds.pop(self._nquads + i, None))
+                    for i in range(nquads) ]
+        del self._inbuf[:nquads * 8]
+        self._nquads += nquads
+        for this, fd in records:
+            self.recordReceived(this, fd)
+
+    def retrieve_initial_info(self, records):
         # 3 longwords: protocol version w/o FD, my (new) ID w/o FD,
-        # and then a -1 with the FD of the IVSHMEM file which is
-        # delivered before this.
-        assert len(data) == 24, 'Initial data needs three quadwords'
-
-        # Enough idiot checks.
-        mailbox_fd = self.latest_fd
-        version, self.id, minusone = struct.unpack('qqq', data)
-        assert version == self.CLIENT_IVSHMEM_PROTOCOL_VERSION, \
-            'Unxpected protocol version %d' % version
-        assert minusone == -1, \
-            'Expected -1 with mailbox fd, got %d' % minuseone
+        # and then a -1 with the FD of the IVSHMEM file.
+        (version, _), (self.id, _), (minusone, mailbox_fd) = records
+
+        # Enough idiot checks.  Version was checked on arrival.
+        assert minusone == -1 and mailbox_fd is not None, \
+            'Expected -1 with mailbox fd, got %d' % minusone
         assert 1 <= self.id, 'My ID is bad: %d' % self.id
         self.nodename = 'z%02d' % self.id
         print('This ID = %2d (%s)' % (self.id, self.nodename))
@@ -195,26 +236,33 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             fd=mailbox_fd, client_id=self.id, nodename=self.nodename)
         self.SI.nClients = mailbox.nClients
         self.SI.nEvents = mailbox.nEvents
+        self.SI.nVectors = mailbox.vectors or mailbox.nEvents
         self.SI.server_id = mailbox.server_id
+        check_fd_budget(fd_budget(self.SI.nClients, self.SI.nVectors)[1],
+            self.nodename)
 
     # Called multiple times so keep state info about previous calls.
-    def dataReceived(self, data):
+    def recordReceived(self, this, latest_fd):
         if self.id is None and self.firstpass:
-            self.retrieve_initial_info(data)
+            self._initial.append((this, latest_fd))
+            if len(self._initial) == 1:     # Server may be bombing me
+                assert this == self.CLIENT_IVSHMEM_PROTOCOL_VERSION, \
+                    'Unxpected protocol version %d' % this
+            elif len(self._initial) == 3:
+                self.retrieve_initial_info(self._initial)
             return      # But I'll be right back :-)
 
         # Now into the stream of <peer id><eventfd> pairs.  Unless it's
         # a single <peer id> which is a disconnect notification.
-        latest_fd = self.latest_fd
-        assert len(data) == 8, 'Expecting a signed long long'
-        this = struct.unpack('q', data)[0]
         if self.SI.args.verbose > 1:
             print('Just got index %s, fd %s' % (this, latest_fd))
         assert this >= 0, 'Latest data is negative number'
 
         if latest_fd is None:   # "this" is a disconnect notification
             print('%s (%d) has left the building' %
-                (self.id2nodename[this], this))
+                (self.id2nodename.get(this, 'Peer'), this))
+            forget_peer(this)
+            FAMEZ_MailBox.drop_queued(this)
             for collection in (self.id2EN_list, self.id2nodename, self.id2fd_list):
                 try:
                     del collection[this]
@@ -222,12 +270,13 @@ class ProtocolIVSHMSGClient(TIPProtocol):
                     pass
             return
 
-        # Get a stream of batched integers, max batch length == nEvents
-        # (the dummy slot 0, nClients, and the server).  There will be
-        # one batch for each existing peer, then the server (see
-        # the "voodoo" comment in twisted_server.py).  In general the
-        # batch lengths could be different for each peer, but in FAME-Z
-        # they're all the same.  Just shove all fds in, including mine.
+        # Get a stream of batched integers, max batch length == nVectors
+        # (nEvents: the dummy slot 0, nClients, and the server; or just
+        # COMPACT_VECTORS).  There will be one batch for each existing
+        # peer, then the server (see the "voodoo" comment in
+        # twisted_server.py).  In general the batch lengths could be
+        # different for each peer, but in FAME-Z they're all the same.
+        # Just shove all fds in, including mine.
 
         # Am I starting the last batch (eventfds for me that need notifiers?)
         if this == self.id and not self.SI.server_id:
@@ -238,7 +287,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         try:
             tmp = len(self.id2fd_list[this])
             assert tmp <= self.SI.server_id, 'fd list is too long'
-            if tmp == self.SI.nEvents:   # Beginning of client reconnect
+            if tmp == self.SI.nVectors:  # Beginning of client reconnect
                 assert this != self.id, 'Updating MY eventfds??? off-by-one'
                 raise KeyError('Forced update')
             self.id2fd_list[this].append(latest_fd)   # order matters
@@ -254,7 +303,7 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         # vector lists are the same length.  My vectors come last during
         # first pass.  During a new client join it's only their info.
         if ((self.firstpass and this != self.id) or
-            (len(self.id2fd_list[this]) < self.SI.nEvents)):
+            (len(self.id2fd_list[this]) < self.SI.nVectors)):
             if self.SI.args.verbose > 1:
                 print('This (%d) waiting for more fds...\n' % this)
             return
@@ -274,10 +323,21 @@ class ProtocolIVSHMSGClient(TIPProtocol):
         if self.firstpass:
             self.get_nodenames()    # From mailbox, including mine
             if this == self.id:
+                hush = poll = None
+                if self.SI.args.suppress and FAMEZ_MailBox.can_suppress():
+                    hush = functools.partial(FAMEZ_MailBox.suppress, self.id)
+                    poll = self._poll
+                elif self.SI.args.suppress:
+                    print('Doorbell suppression needs compact or rings')
+                self.dispatcher = EventfdDispatcher(
+                    spin=self.SI.args.spin, hush=hush, poll=poll)
                 for i, N in enumerate(self.id2EN_list[self.id]):
                     N.num = i
-                    tmp = EventfdReader(N, self.ClientCallback, self)
-                    tmp.start()
+                    self.dispatcher.add(N, self.ClientCallback, self)
+                self.dispatcher.start()
+                FAMEZ_MailBox.want_release(self.id)
+                FAMEZ_MailBox.want_multicast(self.id)
+                FAMEZ_MailBox.want_fragments(self.id)
 
             msg = 'Ready player %s' % self.nodename
             if self.SI.args.verbose:
@@ -305,21 +365,59 @@ class ProtocolIVSHMSGClient(TIPProtocol):
     # first get the list for dest, then pick out src ("from me") trigger EN.
     @property
     def responder_EN(self):
-        return self.id2EN_list[self.requester_id][self.responder_id]
+        return self.class_EN(FAMEZ_MailBox.TC_DATA)
+
+    def class_EN(self, tclass):
+        return self.id2EN_list[self.requester_id][
+            FAMEZ_MailBox.vector(self.responder_id, tclass)]
 
     # The cbdata is precisely the object which can be used for the response.
+    # count is the number of kicks that coalesced into this wakeup; drain()
+    # takes everything pending so none of them are lost.  In compact mode
+    # one vector serves every sender.  With traffic classes everybody's
+    # control mail is served before anybody's data.
     @staticmethod
-    def ClientCallback(vectorobj):
-        requester_id = vectorobj.num
-        requester_name, request = FAMEZ_MailBox.retrieve(requester_id)
+    def ClientCallback(vectorobj, count=1):
         responder = vectorobj.cbdata
+        if vectorobj.num == FAMEZ_MailBox.RELEASE_VECTOR:
+            FAMEZ_MailBox.released(responder.id)
+            return
+        for tclass in FAMEZ_MailBox.by_priority(vectorobj.num):
+            for requester_id in FAMEZ_MailBox.senders(
+                vectorobj.num, responder.id, tclass):
+                ProtocolIVSHMSGClient._serve(
+                    responder, requester_id, count, tclass)
 
-        # Need to be set each time because of spoof cabability, especiall
-        # with destinations like "other" and "all"
-        responder.requester_id = requester_id
-        responder.responder_id = responder.id   # Not like twisted_server.py
-
-        handle_request(request, requester_name, responder)
+    @staticmethod
+    def _serve(responder, requester_id, count, tclass=None):
+        '''Returns the number of messages taken.'''
+        mail = FAMEZ_MailBox.drain(requester_id, responder.id, asbytes=True,
+            tclass=tclass)
+        if responder.SI.args.verbose > 2 and count > 1:
+            print('%d kicks from %d, %d messages' % (
+                count, requester_id, len(mail)))
+        if mail and FAMEZ_MailBox.wants_release(requester_id):
+            try:
+                responder.id2EN_list[requester_id][
+                    FAMEZ_MailBox.RELEASE_VECTOR].incr()
+            except (KeyError, IndexError) as e:
+                pass    # It left the building
+
+        for requester_name, request in mail:
+            # Need to be set each time because of spoof cabability, especiall
+            # with destinations like "other" and "all"
+            responder.requester_id = requester_id
+            responder.responder_id = responder.id   # Not like twisted_server.py
+
+            handle_request(request, requester_name, responder)
+        return len(mail)
+
+    # With doorbell suppression, mail that arrived while the flag was up.
+    def _poll(self):
+        taken = 0
+        for tclass, requester_id in FAMEZ_MailBox.pending(self.id):
+            taken += self._serve(self, requester_id, 0, tclass)
+        return taken
 
     #----------------------------------------------------------------------
     # Command line parsing.
@@ -364,6 +462,11 @@ class ProtocolIVSHMSGClient(TIPProtocol):
             print('Link attributes:\n', self.linkattrs)
             print('Peer attributes:\n', self.peerattrs)
 
+            if FAMEZ_MailBox.stats:
+                print('\nMailbox traffic:')
+                for line in FAMEZ_MailBox.stats_report():
+                    print('\t%s' % line)
+
             return True
 
         if cmd in ('h', 'help') or '?' in cmd:
@@ -417,13 +520,16 @@ class ProtocolIVSHMSGClient(TIPProtocol):
 class FactoryIVSHMSGClient(TIPClientFactory):
 
     _required_arg_defaults = {
+        'binary':       False,      # Offer the binary payload codec
         'socketpath':   '/tmp/ivshmem_socket',
+        'spin':         0,          # usecs to poll doorbells before blocking
+        'suppress':     False,      # Hush senders while draining
         'verbose':      0,
     }
 
     def __init__(self, args=None):
         '''Args must be an object with the following attributes:
-           socketpath, verbose
+           binary, socketpath, spin, suppress, verbose
            Suitable defaults will be supplied.'''
 
         # Pass command line args to ProtocolIVSHMSG, then open logging.
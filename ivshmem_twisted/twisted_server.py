@@ -15,8 +15,9 @@ import random
 import struct
 import sys
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from pprint import pprint
+from time import time as NOW
 
 from twisted.python import log as TPlog
 from twisted.python.logfile import DailyLogFile
@@ -32,17 +33,25 @@ from twisted.internet.protocol import Protocol as TIPProtocol
 try:
     from commander import Commander
     from famez_mailbox import FAMEZ_MailBox
-    from famez_requests import handle_request, send_payload
-    from general import ServerInvariant
-    from ivshmem_eventfd import ivshmem_event_notifier_list, EventfdReader
+    from famez_requests import (
+        handle_request, send_payload, parse_cache_info, forget_peer,
+        tag_info)
+    from general import ServerInvariant, fd_budget, check_fd_budget
+    from ivshmem_eventfd import ivshmem_event_notifier_list, EventfdDispatcher
+    from ivshmem_eventfd import IVSHMEM_Event_Notifier
     from ivshmem_sendrecv import ivshmem_send_one_msg
+    from ivshmem_sendrecv import ivshmem_pack_one_msg, ivshmem_send_packed
 except ImportError as e:
     from .commander import Commander
     from .famez_mailbox import FAMEZ_MailBox
-    from .famez_requests import handle_request, send_payload
-    from .general import ServerInvariant
-    from .ivshmem_eventfd import ivshmem_event_notifier_list, EventfdReader
+    from .famez_requests import (
+        handle_request, send_payload, parse_cache_info, forget_peer,
+        tag_info)
+    from .general import ServerInvariant, fd_budget, check_fd_budget
+    from .ivshmem_eventfd import ivshmem_event_notifier_list, EventfdDispatcher
+    from .ivshmem_eventfd import IVSHMEM_Event_Notifier
     from .ivshmem_sendrecv import ivshmem_send_one_msg
+    from .ivshmem_sendrecv import ivshmem_pack_one_msg, ivshmem_send_packed
 
 # Don't use peer ID 0, certain docs imply it's reserved.  Put the clients
 # from 1 - nClients, and the server goes at nClients + 1.  Then use slot
@@ -87,14 +96,31 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             # of the fds it would use to trigger here.
 
             if not factory.cmdlineargs.silent:
-                SI.EN_list = ivshmem_event_notifier_list(SI.nEvents)
+                SI.EN_list = ivshmem_event_notifier_list(SI.nVectors)
                 # The actual client doing the sending needs to be fished out
-                # via its "num" vector.
+                # via its "num" vector.  Vector 0 can't carry mail (slot 0
+                # is the globals) so it's the release doorbell.  One
+                # dispatcher (epoll) serves them all.
+                hush = poll = None
+                if SI.args.suppress and FAMEZ_MailBox.can_suppress():
+                    hush = functools.partial(
+                        FAMEZ_MailBox.suppress, SI.server_id)
+                    poll = functools.partial(self._poll, SI)
+                elif SI.args.suppress:
+                    SI.logmsg('Doorbell suppression needs compact or rings')
+                SI.dispatcher = EventfdDispatcher(
+                    spin=SI.args.spin, hush=hush, poll=poll)
                 for i, EN in enumerate(SI.EN_list):
                     EN.num = i
-                    tmp = EventfdReader(EN, self.ServerCallback, SI)
-                    if i:   # Technically it blocks mailslot 0, the globals
-                        tmp.start()
+                    SI.dispatcher.add(EN, self.ServerCallback, SI)
+                SI.dispatcher.start()
+                SI.adverts = [ ivshmem_pack_one_msg(SI.server_id, EN.wfd)
+                               for EN in SI.EN_list ]
+                FAMEZ_MailBox.want_release(SI.server_id)
+                FAMEZ_MailBox.want_multicast(SI.server_id)
+                FAMEZ_MailBox.want_fragments(SI.server_id)
+
+            self._refill_pool()     # Warm up for the joins after this one
 
         self.create_new_peer_id()
         self.peerattrs = {
@@ -119,6 +145,7 @@ class ProtocolIVSHMSGServer(TIPProtocol):
     # If errors occur early enough, send a bad revision to the client so it
     # terminates the connection.  Remember, "self" is a proxy for a peer.
     def connectionMade(self):
+        self.join_started = NOW()
         recycled = self.SI.recycled.get(self.id, None)
         if recycled:
             del self.SI.recycled[recycled.id]
@@ -132,10 +159,6 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             self.send_initial_info(False)   # client complains but with grace
             return
 
-        # The original original code was written around this variable name.
-        # Keep that convention for easier comparison.
-        server_peer_list = list(self.SI.clients.values())
-
         # Server line 175: create specified number of eventfds.  These are
         # shared with all other clients who use them to signal each other.
         # Recycling keeps QEMU sessions from dying when other clients drop,
@@ -144,11 +167,15 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             self.EN_list = recycled.EN_list
         else:
             try:
-                self.EN_list = ivshmem_event_notifier_list(self.SI.nEvents)
+                self.EN_list = self._pooled_EN_list()
             except Exception as e:
                 self.SI.logmsg('Event notifiers failed: %s' % str(e))
                 self.send_initial_info(False)
                 return
+        # Every later join advertises these again, so pack them just once.
+        self.adverts = [ ivshmem_pack_one_msg(self.id, EN.wfd)
+                         for EN in self.EN_list ]
+        self.recycled = bool(recycled)
 
         # Server line 183: send version, peer id, shm fd
         if self.SI.args.verbose:
@@ -157,59 +184,110 @@ class ProtocolIVSHMSGServer(TIPProtocol):
             self.SI.logmsg('Send initial info failed')
             return
 
+        # The rest goes through the join queue, see _advertise().
+        self.advert_sequence = None     # Built at the head of the queue
+        self.advertised = set()         # Ids whose fds it has been sent
+        self.SI.joining[self.id] = self
+        self._kick_joins(self.SI)
+
+    # Joins are advertised one at a time in the order they connected, so
+    # every peer gets the same sequence as if each had been done entirely
+    # in connectionMade (the original code).  A join is prepacked when it
+    # gets to the head of the queue, then pushed ADVERT_CHUNK sendmsg()s
+    # per reactor turn so a join storm doesn't stall the mail.  It's still
+    # one 8-byte datum per fd, which QEMU needs.  Only SI.join_pump ever
+    # advances the queue so a head is never advertised twice.
+
+    ADVERT_CHUNK = 64
+
+    @staticmethod
+    def _kick_joins(SI):
+        if SI.join_pump is None and SI.joining:
+            SI.join_pump = TIreactor.callLater(0,
+                ProtocolIVSHMSGServer._advertise, SI)
+
+    def _advertisement(self):
+        # The original original code was written around this variable name.
+        # Keep that convention for easier comparison.
+        server_peer_list = list(self.SI.clients.values())
+        sequence = []
+
         # Server line 189: advertise the new peer to others.  Note that
         # this new peer has not yet been added to the list; this loop is
         # NOT traversed for the first peer to connect.
-        if not recycled:
-            if self.SI.args.verbose:
-                PRINT('NOT recycled: advertising other peers...')
+        # Entries are (peer to send to, packed, id whose fd it is).
+        if not self.recycled:
             for other_peer in server_peer_list:
-                for peer_EN in self.EN_list:
-                    ivshmem_send_one_msg(
-                        other_peer.transport.socket,
-                        self.id,
-                        peer_EN.wfd)
+                sequence.extend((other_peer, packed, self.id)
+                                for packed in self.adverts)
 
         # Server line 197: advertise the other peers to the new one.
         # Remember "this" new peer proxy has not been added to the list yet.
-        if self.SI.args.verbose:
-            PRINT('Advertising other peers to the new peer...')
         for other_peer in server_peer_list:
-            for other_peer_EN in other_peer.EN_list:
-                ivshmem_send_one_msg(
-                    self.transport.socket,
-                    other_peer.id,
-                    other_peer_EN.wfd)
+            sequence.extend((self, packed, other_peer.id)
+                            for packed in other_peer.adverts)
 
         # Non-standard voodoo extension to previous advertisment: advertise
         # this server to the new peer.  To QEMU it just looks like one more
         # grouping in the previous batch.  Exists only in non-silent mode.
-        if self.SI.args.verbose:
-            PRINT('Advertising this server to the new peer...')
-        for server_EN in self.SI.EN_list:
-            ivshmem_send_one_msg(
-                self.transport.socket,
-                self.SI.server_id,
-                server_EN.wfd)
+        sequence.extend((self, packed, self.SI.server_id)
+                        for packed in self.SI.adverts)
 
         # Server line 205: advertise the new peer to itself, ie, send the
         # eventfds it needs for receiving messages.  This final batch
         # where the embedded self.id matches the initial_info id is the
         # sentinel that communications are finished.
-        if self.SI.args.verbose:
-            PRINT('Advertising the new peer to itself...')
-        for peer_EN in self.EN_list:
-            ivshmem_send_one_msg(
-                self.transport.socket,
-                self.id,
-                peer_EN.get_fd())   # Must be a good story here...
-
-        # And now that it's finished:
-        self.SI.clients[self.id] = self
+        sequence.extend((self, ivshmem_pack_one_msg(self.id, EN.get_fd()),
+                         self.id)
+                        for EN in self.EN_list)     # Must be a good story here
+        return deque(sequence)
 
-        if self.SI.args.smart:
+    @staticmethod
+    def _advertise(SI):
+        SI.join_pump = None
+        if not SI.joining:
+            return
+        head = next(iter(SI.joining.values()))
+        if head.advert_sequence is None:
+            if SI.args.verbose:
+                PRINT('Advertising peer id %d (%srecycled)...' % (
+                    head.id, '' if head.recycled else 'NOT '))
+            head.advert_sequence = head._advertisement()
+            head.advert_count = len(head.advert_sequence)
+        sequence = head.advert_sequence
+        for _ in range(min(head.ADVERT_CHUNK, len(sequence))):
+            peer, packed, about = sequence.popleft()
+            if peer is head:
+                head.advertised.add(about)
+            # A dead peer's socket is gone (recycling keeps it listed)
+            ivshmem_send_packed(
+                getattr(peer.transport, 'socket', None), packed)
+        if not sequence:
+            head._joined()
+        ProtocolIVSHMSGServer._kick_joins(SI)
+
+    def _joined(self):
+        SI = self.SI
+        del SI.joining[self.id]
+        SI.clients[self.id] = self
+        SI.logmsg('Peer id %d joined in %.1f ms (%d fds, %d waiting)' % (
+            self.id, (NOW() - self.join_started) * 1000,
+            self.advert_count, len(SI.joining)))
+
+        if SI.args.smart:
             send_payload(self, 'Link CTL Peer-Attribute')
 
+    def _drop_adverts(self, gone):
+        '''gone died while I was being advertised: cut it out of the rest
+           of my sequence, and if I already have some of its fds, tell me
+           it's gone like the peers that finished joining.'''
+        if self.advert_sequence is None:
+            return
+        self.advert_sequence = deque(entry for entry in self.advert_sequence
+            if entry[0] is not gone and entry[2] != gone.id)
+        if gone.id in self.advertised:
+            ivshmem_send_one_msg(self.transport.socket, gone.id)
+
     def connectionLost(self, reason):
         '''Tell the other peers that this one has died.'''
         if reason.check(TIError.ConnectionDone) is None:    # Dirty
@@ -219,6 +297,11 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         self.SI.logmsg('%s disconnect from peer id %d' % (txt, self.id))
         if self.id in self.SI.clients:     # Only if everything was completed
             del self.SI.clients[self.id]
+        if self.SI.joining.get(self.id) is self:    # Stops its advertising
+            del self.SI.joining[self.id]
+        forget_peer(self.id)
+        FAMEZ_MailBox.drop_queued(self.id)
+        self.SI.throttled.discard(self.id)
         if self.SI.args.recycle:
             self.SI.recycled[self.id] = self
             return
@@ -226,9 +309,12 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         try:
             for other_peer in self.SI.clients.values():
                 ivshmem_send_one_msg(other_peer.transport.socket, self.id)
+            for joiner in self.SI.joining.values():
+                joiner._drop_adverts(self)
 
             for EN in self.EN_list:
                 EN.cleanup()
+            self._refill_pool()     # Its id is free again
 
             # For QEMU crashes and shutdowns.  Not the VM, but QEMU itself.
             FAMEZ_MailBox.clear_mailslot(self.id)
@@ -236,31 +322,71 @@ class ProtocolIVSHMSGServer(TIPProtocol):
         except Exception as e:
             self.SI.logmsg('Closing peer transports failed: %s' % str(e))
 
+    #----------------------------------------------------------------------
+    # Warm pool of eventfd sets so a join doesn't create nEvents of them on
+    # the spot.  It's refilled one set per reactor turn, up to a set for
+    # every client id not in use, joining or held for recycling.  If the fd
+    # limit gets in the way the pool just stops growing.
+
+    @classmethod
+    def _pooled_EN_list(cls):
+        SI = cls.SI
+        if SI.EN_pool:
+            EN_list = SI.EN_pool.popleft()
+        else:
+            EN_list = ivshmem_event_notifier_list(SI.nVectors)
+        cls._refill_pool()
+        return EN_list
+
+    @classmethod
+    def _refill_pool(cls):
+        if cls.SI.EN_refill is None:
+            cls.SI.EN_refill = TIreactor.callLater(0, cls._refill_one)
+
+    @classmethod
+    def _refill_one(cls):
+        SI = cls.SI
+        SI.EN_refill = None
+        wanted = SI.nClients - len(SI.clients) - len(SI.joining) - \
+                 len(SI.recycled)
+        if len(SI.EN_pool) >= wanted:
+            return
+        try:
+            SI.EN_pool.append(ivshmem_event_notifier_list(SI.nVectors))
+        except Exception as e:
+            SI.logmsg('Eventfd pool stopped at %d sets: %s' % (
+                len(SI.EN_pool), str(e)))
+            return
+        cls._refill_pool()
+
     def create_new_peer_id(self):
         '''Determine the lowest unused client ID and set self.id.'''
 
         self.SID0 = 0   # When queried, the answer is in the context...
         self.CID0 = 0   # ...of the server/switch, NOT the proxy item.
-        if len(self.SI.clients) >= self.SI.nClients:
-            self.id = -1    # sentinel
+        if len(self.SI.clients) + len(self.SI.joining) >= self.SI.nClients:
+            self.id = self.requester_id = -1    # sentinel
             return  # Until a Link RFC is executed
 
         # dumb: monotonic from 1; smart: random (finds holes in the code).
         # Generate ID sets used by each.
-        active_ids = frozenset(self.SI.clients.keys())
+        active_ids = frozenset(self.SI.clients.keys()) | \
+                     frozenset(self.SI.joining.keys())
         unused_ids = frozenset((range(self.SI.nClients + 2))) - \
                      frozenset((IVSHMEM_UNUSED_ID, self.SI.server_id))
         available_ids = unused_ids - active_ids
         if self.SI.args.smart:
             self.id = random.choice(tuple(available_ids))
         else:
-            if not self.SI.clients:   # empty
+            if not active_ids:   # empty
                 self.id = 1
             else:
                 self.id = (sorted(available_ids))[0]
 
+        self.requester_id = self.id     # Destination for send_payload()
+
         # FIXME: This should have been set up before socket connection made?
-        self.nodename, _ = FAMEZ_MailBox.retrieve(self.id, clear=False)
+        self.nodename = FAMEZ_MailBox._nodename(self.id)
         if self.SI.args.smart:
             self.SID0 = self.SI.default_SID
             self.CID0 = self.id * 100
@@ -296,29 +422,88 @@ class ProtocolIVSHMSGServer(TIPProtocol):
     # first get the list for dest, then pick out src ("from") trigger EN.
     @property
     def responder_EN(self):
-        return self.EN_list[self.responder_id]  # requester not used
+        return self.class_EN(FAMEZ_MailBox.TC_DATA)
+
+    def class_EN(self, tclass):
+        return self.EN_list[FAMEZ_MailBox.vector(self.responder_id, tclass)]
 
     # The cbdata is a class variable common to all requester proxy objects.
     # The object which serves as the responder needs to be calculated.
+    # count is the number of kicks that coalesced into this wakeup; drain()
+    # takes everything pending so none of them are lost.  In compact mode
+    # one vector serves every sender.  With traffic classes everybody's
+    # control mail is served before anybody's data.
     @staticmethod
-    def ServerCallback(vectorobj):
-        requester_id = vectorobj.num
-        requester_name, request = FAMEZ_MailBox.retrieve(requester_id)
+    def ServerCallback(vectorobj, count=1):
         SI = vectorobj.cbdata
+        if vectorobj.num == FAMEZ_MailBox.RELEASE_VECTOR:
+            FAMEZ_MailBox.released(SI.server_id)
+            return
+        for tclass in FAMEZ_MailBox.by_priority(vectorobj.num):
+            for requester_id in FAMEZ_MailBox.senders(
+                vectorobj.num, SI.server_id, tclass):
+                ProtocolIVSHMSGServer._serve(SI, requester_id, count, tclass)
+
+    # Backpressure: while the responses already queued to a requester are
+    # over QUEUE_HIGH, leave its requests in its ring (so its own fills
+    # wait) and pick them up once the backlog is down to QUEUE_LOW.  A
+    # single cell would just sit full until the requester stomped it, so
+    # without a ring keep draining; past QUEUE_LIMIT responses fail and
+    # _transmit() logs them.
+    @staticmethod
+    def _serve(SI, requester_id, count, tclass=None):
+        '''Returns the number of messages taken.'''
+        if tclass == FAMEZ_MailBox.TC_CONTROL:
+            pass                                # Never held back
+        elif requester_id in SI.throttled:
+            return 0
+        elif (FAMEZ_MailBox.depth > 1 and
+              FAMEZ_MailBox.backlog(SI.server_id, requester_id) >=
+              FAMEZ_MailBox.QUEUE_HIGH):
+            SI.throttled.add(requester_id)
+            if SI.args.verbose:
+                SI.logmsg('Throttling requests from %d' % requester_id)
+            FAMEZ_MailBox.when_room(SI.server_id, requester_id,
+                functools.partial(ProtocolIVSHMSGServer._unthrottle,
+                    SI, requester_id))
+            return 0
+        mail = FAMEZ_MailBox.drain(requester_id, SI.server_id, asbytes=True,
+            tclass=tclass)
+        if SI.args.verbose > 2 and count > 1:
+            SI.logmsg('%d kicks from %d, %d messages' % (
+                count, requester_id, len(mail)))
 
         # The requester can die between its request and this callback.
         try:
             responder = SI.clients[requester_id]
         except KeyError as e:
             SI.logmsg('Disappeering act by %d' % requester_id)
-            return
+            return len(mail)
         responder.requester_id = requester_id   # FIXME: is this necessary?
+        if mail and FAMEZ_MailBox.wants_release(requester_id):
+            responder.EN_list[FAMEZ_MailBox.RELEASE_VECTOR].incr()
+
+        # A ring may hold several requests; handle them in order.
+        for requester_name, request in mail:
+            # For QEMU/VM, this may be the first chance to get the nodename.
+            if not responder.nodename:
+                responder.nodename = requester_name
+            ret = handle_request(request, requester_name, responder)
+        return len(mail)
+
+    # With doorbell suppression, mail that arrived while the flag was up.
+    @staticmethod
+    def _poll(SI):
+        taken = 0
+        for tclass, requester_id in FAMEZ_MailBox.pending(SI.server_id):
+            taken += ProtocolIVSHMSGServer._serve(SI, requester_id, 0, tclass)
+        return taken
 
-        # For QEMU/VM, this may be the first chance to retreive the filename.
-        if not responder.nodename:
-            responder.nodename = requester_name
-
-        ret = handle_request(request, requester_name, responder)
+    @staticmethod
+    def _unthrottle(SI, requester_id):
+        SI.throttled.discard(requester_id)
+        if requester_id in SI.clients:
+            ProtocolIVSHMSGServer._serve(SI, requester_id, 0)
 
     #----------------------------------------------------------------------
     # Command line parsing.
@@ -338,12 +523,22 @@ class ProtocolIVSHMSGServer(TIPProtocol):
                     PRINT('%10s: %s' % (peer.nodename, peer.peerattrs))
                     if self.SI.args.verbose > 2:
                         PPRINT(vars(peer), stream=sys.stdout)
+            if self.SI.args.verbose:
+                for name, info in parse_cache_info().items():
+                    PRINT('%10s parse cache: %d hits %d misses %d/%d' % (
+                        name, info.hits, info.misses, info.currsize,
+                        info.maxsize))
+                PRINT('Outstanding tags by peer: %s' % tag_info())
+            PRINT('Outbound queue depths: %s%s' % (
+                FAMEZ_MailBox.backlogs(self.SI.server_id) or '{}',
+                ', throttled %s' % sorted(self.SI.throttled)
+                    if self.SI.throttled else ''))
 
             # ASCII art switch: Print full left side, right justifed, into 30
             clients = self.SI.clients
             lfmt = '%s %s [%s,%s]'
             rfmt = '[%s,%s] %s %s'
-            limit = (FAMEZ_MailBox.MAILBOX_MAX_SLOTS - 1) // 2
+            limit = (self.SI.nClients + 1) // 2
             N = 34
             lspaces = ' ' * N
             PRINT('%s  _________' % lspaces)
@@ -369,6 +564,11 @@ class ProtocolIVSHMSGServer(TIPProtocol):
                     ldesc[-N:], left, right, rdesc))
             PRINT('%s  =========' % lspaces)
 
+            if FAMEZ_MailBox.stats:
+                PRINT('')
+                for line in FAMEZ_MailBox.stats_report():
+                    PRINT(line)
+
             return True
 
         if cmd in ('q', 'quit'):
@@ -386,13 +586,28 @@ class ProtocolIVSHMSGServer(TIPProtocol):
 class FactoryIVSHMSGServer(TIPServerFactory):
 
     _required_arg_defaults = {
+        'binary':       False,      # Offer the binary payload codec
         'foreground':   True,       # Only affects logging choice in here
+        'hugepages':    False,      # Mailbox on huge pages
         'logfile':      '/tmp/ivshmem_log',
         'mailbox':      'ivshmem_mailbox',  # Will end up in /dev/shm
+        'memfd':        False,      # Anonymous mailbox, fd only
+        'multicast':    False,      # Ack table for one-copy multicast
+        'compact':      False,      # Two vectors per peer, not nEvents
+        'classes':      False,      # Control traffic class (compact only)
         'nClients':     2,
+        'notifier':     None,       # Eventfd backend, None for best
+        'prefault':     False,      # Populate and mlock the mailbox
         'recycle':      False,      # Try to preserve other QEMUs
+        'retries':      2,          # Retransmissions of tagged requests
+        'slotsize':     512,        # Mailslot bytes, power of two
+        'depth':        1,          # Mailslot ring depth per sender
+        'matrix':       False,      # One ring per sender/destination
         'silent':       False,      # Does participate in eventfds/mailbox
         'socketpath':   '/tmp/ivshmem_socket',
+        'spin':         0,          # usecs to poll doorbells before blocking
+        'suppress':     False,      # Hush senders while draining
+        'tagtime':      1000,       # ms to wait for a tagged request's ACK
         'verbose':      0,
     }
 
@@ -406,12 +621,15 @@ class FactoryIVSHMSGServer(TIPServerFactory):
             args = argparse.Namespace()
         for arg, default in self._required_arg_defaults.items():
             setattr(args, arg, getattr(args, arg, default))
+        if args.notifier:
+            IVSHMEM_Event_Notifier.use_backend(args.notifier)
 
         # Mailbox may be sized above the requested number of clients to
         # satisfy QEMU IVSHMEM restrictions.
         args.server_id = args.nClients + 1
         args.nEvents = args.nClients + 2
         FAMEZ_MailBox(args=args)  # singleton class, no need to keep instance
+        args.nVectors = FAMEZ_MailBox.vectors or args.nEvents
 
         self.cmdlineargs = args
         if args.foreground:
@@ -423,6 +641,11 @@ class FactoryIVSHMSGServer(TIPServerFactory):
                 setStdout=True)     # "Pass-through" explicit print() for debug
         args.logmsg = TPlog.msg
         args.logerr = TPlog.err
+        server_fds, client_fds = fd_budget(args.nClients, args.nVectors)
+        check_fd_budget(server_fds, 'Server', args.logmsg)
+        args.logmsg('Each client needs about %d fds (%d vectors per peer%s)' %
+            (client_fds, args.nVectors, ', compact' if FAMEZ_MailBox.vectors
+                                                   else ''))
 
         # By Twisted version 18, "mode=" is deprecated and you should just
         # inherit the tacky bit from the parent directory.  wantPID creates
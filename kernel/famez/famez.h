@@ -30,15 +30,29 @@ struct ivshmem_msi_x_table_pba {	// BAR 1: Not mapped, not used.  YET.
 };
 
 // The famez_server.py controls the mailbox slot size and number of slots
-// (and therefore the total file size).  It gives these numbers to this driver.
+// (and therefore the total file size).  It gives these numbers to this driver;
+// nSlots (a power of two, at least 16) is only informational here.
 // There are always a power-of-two number of mailbox slots, indexed by IVSHMSG
 // client ID.  Slot 0 is reserved for global data cuz it's easy to find :-)
 // Besides, ID 0 doesn't seem to work in the QEMU doorbell mechanism.  The
 // last slot (with ID == nClients + 1) is for the Python server.  The remaining
 // slots are for client IDs 1 through nClients.
 
+// A non-zero ring_offset means each sender posts through rings ("lanes")
+// of depth cells starting at cell_offset, with (head, tail) pairs at
+// ring_offset.  lanes > 1 is one lane per destination.  Only the Python
+// peers speak that; this driver needs ring_offset == 0.
+
+// Likewise non-zero vectors means every sender rings the same few vectors
+// and receivers scan for the cells; this driver needs vector == sender id.
+
 struct famez_globals {			// BAR 2: Start of IVSHMEM
-	uint64_t slotsize, buf_offset, nClients, nEvents, server_id;
+	uint64_t slotsize, buf_offset, nClients, nEvents, server_id,
+		 depth, ring_offset, cell_offset, lanes, nSlots,
+		 flags,			// Python: prefault, hugepages
+		 ack_offset,		// Python: multicast acks
+		 vectors,		// Python: compact doorbells
+		 classes;		// Python: traffic classes
 };
 
 // Use only uint64_t and keep the buf[] on a 32-byte alignment for this:
@@ -50,7 +64,12 @@ struct __attribute__ ((packed)) famez_mailslot {
 		 last_responder,	// off 48: To assist stale stompage
 		 peer_SID,		// off 56: Calculated in MSI-X...
 		 peer_CID,		// off 64: ...from last_responder
-		 pad[7];		// off 72
+		 frag,			// off 72: Python fragment header
+		 flags,			// off 80: Python owner flags
+		 seq,			// off 88: Python sequence number
+		 rcvmask,		// off 96: Python multicast receivers
+		 mcast_id,		// off 104: Python multicast ack value
+		 pad[2];		// off 112
 	char buf[];			// off 128 == globals->buf_offset
 };
 
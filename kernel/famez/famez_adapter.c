@@ -166,6 +166,16 @@ struct famez_adapter *famez_adapter_create(struct pci_dev *pdev)
 		pr_err(FZ "MSG_OFFSET global is > SLOTSIZE global\n");
 		goto err_kfree;
 	}
+	if (adapter->globals->ring_offset) {
+		pr_err(FZ "mailslot rings (depth %llu, lanes %llu) not supported\n",
+			adapter->globals->depth, adapter->globals->lanes);
+		goto err_kfree;
+	}
+	if (adapter->globals->vectors) {
+		pr_err(FZ "compact vectors (%llu per peer) not supported\n",
+			adapter->globals->vectors);
+		goto err_kfree;
+	}
 	adapter->max_buflen = adapter->globals->slotsize -
 			     adapter->globals->buf_offset;
 	adapter->my_id = adapter->regs->IVPosition;